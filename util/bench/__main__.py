@@ -0,0 +1,175 @@
+import os
+import sys
+import argparse
+
+# Benchmarks for the build tools. Run from the repo root:
+#   python3 util/bench gen --words 100000 -o /tmp/book.text
+#   python3 util/bench parser --words 10000,100000 --out new.json
+#   python3 util/bench count --commits 2000 --out count.json
+#   python3 util/bench fuzz --trials 100 --cases util/bench/cases
+#   python3 util/bench compare old.json new.json
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.dirname(HERE)]
+
+import manuscript
+import history
+import results
+
+def add_manuscript_args(argpars):
+	d = manuscript.Manuscript()
+	argpars.add_argument("--chapters", type=int, default=d.chapters)
+	argpars.add_argument("--tag-density", type=float, default=d.tag_density, help="chance of each extra tagged phrase in a sentence")
+	argpars.add_argument("--dialog-ratio", type=float, default=d.dialog_ratio, help="fraction of paragraphs that are dialog")
+	argpars.add_argument("--depth", type=int, default=d.depth, help="deepest nesting of inline tags")
+	argpars.add_argument("--comment-density", type=float, default=d.comment_density)
+	argpars.add_argument("--seed", type=int, default=d.seed)
+
+def mk_manuscript(args, words):
+	return manuscript.Manuscript(words, args.chapters, args.tag_density, args.dialog_ratio,
+		args.depth, args.comment_density, args.seed)
+
+def parse_sizes(s):
+	return [int(float(w)) for w in s.split(",")]
+
+def run_gen(args):
+	manuscript.write(mk_manuscript(args, args.words), args.output)
+
+def run_parser(args):
+	import phases
+	res = results.new_results("parser")
+	inputs = []
+	if args.input:
+		for fname in args.input:
+			with open(fname) as f:
+				inputs.append(({"file": fname}, [line.strip() for line in f]))
+	else:
+		for words in parse_sizes(args.words):
+			m = mk_manuscript(args, words)
+			inputs.append((m.params(), list(manuscript.generate(m))))
+	for (inp, lines) in inputs:
+		print(f"Benchmarking {results.input_label(inp)} ({len(lines)} lines)")
+		run = {"input": inp, "lines": len(lines), "words": manuscript.word_count(lines), "repeat": args.repeat}
+		run["phases"] = phases.bench_lines(lines, args.repeat)
+		for (name, stats) in run["phases"].items():
+			print(f"  {name:<20} {stats['min']*1000:10.2f}ms")
+		res["runs"].append(run)
+	if args.out:
+		results.write_results(args.out, res)
+
+def add_history_args(argpars):
+	d = history.History()
+	argpars.add_argument("--commits", type=int, default=d.commits)
+	argpars.add_argument("--stories", type=int, default=d.stories)
+	argpars.add_argument("--words-per-commit", type=int, default=d.words_per_commit)
+	argpars.add_argument("--edit-lines", type=int, default=d.edit_lines, help="existing lines reworded per commit")
+	argpars.add_argument("--rename-every", type=int, default=d.rename_every, help="rename the active story every N commits (0 = never)")
+	argpars.add_argument("--years", type=int, default=d.years)
+	argpars.add_argument("--seed", type=int, default=d.seed)
+
+def mk_history(args):
+	return history.History(args.commits, args.stories, args.words_per_commit, args.edit_lines,
+		args.rename_every, args.years, args.seed)
+
+def run_history(args):
+	renames = history.make_repo(mk_history(args), os.path.abspath(args.output))
+	for (path, names) in sorted(renames.items()):
+		print(f"{path}: {' <- '.join(reversed(names[:-1])) or 'no renames'}")
+
+# Tracks the counted story that was renamed the most
+def tracked_name(renames):
+	import count
+	paths = [p for p in renames if count.is_counted(p)]
+	best = max(paths, key=lambda p: len(renames[p]))
+	return count.file_key(best)
+
+def run_count(args):
+	import shutil
+	import tempfile
+	import count_phases
+	h = mk_history(args)
+	root = os.path.abspath(args.repo) if args.repo else tempfile.mkdtemp(prefix="count-bench-")
+	try:
+		print(f"Generating {h.commits} commits in {root}")
+		renames = history.make_repo(h, root)
+		name = tracked_name(renames)
+		print(f"Tracking {name}")
+		res = results.new_results("count")
+		scenarios = args.scenarios.split(",") if args.scenarios else count_phases.SCENARIOS
+		for scenario in scenarios:
+			samples = [count_phases.time_scenario(root, scenario, name, args.jobs) for _ in range(args.repeat)]
+			inp = dict(h.params(), scenario=scenario, jobs=args.jobs)
+			run = {"input": inp, "repeat": args.repeat, "tracked": name}
+			run["phases"] = {p: results.summarize([s.get(p, 0.0) for s in samples]) for p in count_phases.PHASES}
+			print(scenario)
+			for (p, stats) in run["phases"].items():
+				print(f"  {p:<20} {stats['min']*1000:10.2f}ms")
+			res["runs"].append(run)
+		if args.out:
+			results.write_results(args.out, res)
+	finally:
+		if not args.repo:
+			shutil.rmtree(root, ignore_errors=True)
+
+def run_fuzz(args):
+	import fuzz
+	found = fuzz.fuzz(args.trials, args.seed, args.budget, args.repeat, args.threshold, args.cases)
+	if args.out:
+		res = results.new_results("fuzz")
+		res["constructs"] = found
+		results.write_results(args.out, res)
+	if any(f["flagged"] for f in found):
+		sys.exit(1)
+
+def run_compare(args):
+	rows = results.compare(results.read_results(args.old), results.read_results(args.new), args.threshold)
+	if results.print_comparison(rows):
+		sys.exit(1)
+
+def main():
+	argpars = argparse.ArgumentParser(prog="bench")
+	sub = argpars.add_subparsers(dest="cmd", required=True)
+
+	gen = sub.add_parser("gen", help="write a synthetic manuscript")
+	gen.add_argument("--words", type=lambda s: int(float(s)), default=100000)
+	gen.add_argument("-o", "--output", required=True)
+	add_manuscript_args(gen)
+
+	par = sub.add_parser("parser", help="time each parser and renderer phase")
+	par.add_argument("--words", default="10000,100000", help="manuscript sizes, comma separated (10k to 5M)")
+	par.add_argument("--input", nargs="*", help="benchmark these .text files instead of generated ones")
+	par.add_argument("--repeat", type=int, default=3)
+	par.add_argument("--out", help="write results as JSON")
+	add_manuscript_args(par)
+
+	hist = sub.add_parser("history", help="generate a git repo of manuscript edits")
+	hist.add_argument("-o", "--output", required=True)
+	add_history_args(hist)
+
+	cnt = sub.add_parser("count", help="time count.py phases over a generated history")
+	cnt.add_argument("--repo", help="generate the history here and keep it (default: a temp dir)")
+	cnt.add_argument("--scenarios", help="comma separated, from cold,warm,all_count_cold,all_count_warm,corpus_cold,corpus_warm (default: all)")
+	cnt.add_argument("--repeat", type=int, default=1)
+	cnt.add_argument("-j", "--jobs", type=int, default=1)
+	cnt.add_argument("--out", help="write results as JSON")
+	add_history_args(cnt)
+
+	fz = sub.add_parser("fuzz", help="look for inputs that parse in worse than linear time")
+	fz.add_argument("--trials", type=int, default=50, help="random constructs to try after the built-in ones")
+	fz.add_argument("--seed", type=int, default=1)
+	fz.add_argument("--budget", type=float, default=0.5, help="stop growing an input once a parse takes this long")
+	fz.add_argument("--repeat", type=int, default=3)
+	fz.add_argument("--threshold", type=float, default=1.3, help="log-log slope above which scaling counts as super-linear")
+	fz.add_argument("--cases", help="save minimized reproducers here as .text files")
+	fz.add_argument("--out", help="write all measurements as JSON")
+
+	cmp = sub.add_parser("compare", help="compare two results files, exit 1 on regressions")
+	cmp.add_argument("old")
+	cmp.add_argument("new")
+	cmp.add_argument("--threshold", type=float, default=results.THRESHOLD, help="slowdown ratio that counts as a regression")
+
+	args = argpars.parse_args()
+	{"gen": run_gen, "parser": run_parser, "history": run_history, "count": run_count,
+		"fuzz": run_fuzz, "compare": run_compare}[args.cmd](args)
+
+if __name__ == '__main__':
+	main()
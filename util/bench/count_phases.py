@@ -0,0 +1,89 @@
+import os
+import io
+import contextlib
+
+import git
+
+import count
+import count_cache
+
+from timer import Timer
+
+# count.py's work is split into phases by wrapping the functions it calls
+# through its own module globals. Timing is exclusive, so each phase only
+# holds its own time and "other" is whatever wasn't attributed.
+PHASES = ["history", "blob_read", "count", "diff", "sqlite", "files", "other", "total"]
+
+SQLITE_FUNCS = ["setup_db", "close_db", "get_last_name", "put_last_name", "get_cached_renames",
+	"put_cached_renames", "get_cached_counts", "put_cached_count", "put_daily_count",
+	"get_daily_totals", "get_daily_rows", "clear_daily", "get_corpus_head", "put_corpus_head",
+	"get_file_index", "find_indexed_file", "put_file_index", "remove_file_index"]
+
+SCENARIOS = ["cold", "warm", "all_count_cold", "all_count_warm", "corpus_cold", "corpus_warm"]
+
+def instrument(timer):
+	saved = {}
+	def patch(obj, name, wrapped):
+		saved[(obj, name)] = getattr(obj, name)
+		setattr(obj, name, wrapped)
+	for name in SQLITE_FUNCS:
+		patch(count, name, timer.wrap("sqlite", getattr(count, name)))
+	for name in ["get_rename", "touched_files"]:
+		patch(count, name, timer.wrap("history", getattr(count, name)))
+	patch(git.Repo, "iter_commits", timer.wrap_iter("history", git.Repo.iter_commits))
+	patch(count, "slurp_commit", timer.wrap("blob_read", count.slurp_commit))
+	for name in ["count_revs", "count_file"]:
+		patch(count, name, timer.wrap("count", getattr(count, name)))
+	patch(count, "diff_multisets", timer.wrap("diff", count.diff_multisets))
+	patch(count, "find_file", timer.wrap("files", count.find_file))
+	patch(count.glob, "glob", timer.wrap("files", count.glob.glob))
+	return saved
+
+def restore(saved):
+	for ((obj, name), f) in saved.items():
+		setattr(obj, name, f)
+
+def nuke_db():
+	for suffix in ("", "-wal", "-shm"):
+		if os.path.exists(count_cache.DB_NAME + suffix):
+			os.remove(count_cache.DB_NAME + suffix)
+
+def run_scenario(scenario, name):
+	if scenario in ("cold", "all_count_cold", "corpus_cold"):
+		nuke_db()
+	cache = count.setup_db(False)
+	try:
+		if scenario.startswith("all_count"):
+			count.count_all(cache)
+		elif scenario.startswith("corpus"):
+			count.run_corpus(cache)
+		else:
+			count.run_count(cache, name)
+	finally:
+		count.close_db(cache)
+
+# Runs one scenario in the repo at root and returns its phase times. count.py
+# works relative to the current directory and STORY_ROOT, so both are set for
+# the duration.
+# (String, String, String, Int) -> {String: Float}
+def time_scenario(root, scenario, name, jobs):
+	cwd = os.getcwd()
+	env = os.environ.get("STORY_ROOT")
+	os.chdir(root)
+	os.environ["STORY_ROOT"] = root
+	(count.JOBS, count.DEBUG, count_cache.DEBUG) = (jobs, False, False)
+	timer = Timer(exclusive=True)
+	saved = instrument(timer)
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			timer.run("other", run_scenario, scenario, name)
+	finally:
+		restore(saved)
+		os.chdir(cwd)
+		if env is None:
+			del os.environ["STORY_ROOT"]
+		else:
+			os.environ["STORY_ROOT"] = env
+	times = timer.times
+	times["total"] = sum(times.values())
+	return times
@@ -0,0 +1,159 @@
+import io
+import os
+import math
+import time
+import random
+import contextlib
+
+import parser as P
+
+# Looks for inputs whose parse time grows faster than their size. Each
+# construct is a short unit repeated n times, either along one line or as n
+# lines of one chapter. Its parse time is measured at doubling sizes and the
+# slope of log(time) against log(size) is fitted: about 1 is linear, 2 is
+# quadratic. Anything over the threshold is shrunk to the smallest unit that
+# still scales badly and saved as a .text case for bench parser --input.
+
+HEADER = [":Title:Fuzz", ":Author:Fuzz", "", "//!!!//", "", "##1 (Chapter 1) fuzz", ""]
+ALPHABET = ["*", "|", "`", "``", "'", "''", "/", "{", "}", "@", ">", ">>", "\\\\", "a", " ", "A>",
+	"%", "-", "#", "/*", "*/", "."]
+THRESHOLD = 1.3
+# below this a timing is mostly call overhead and says nothing about scaling
+MIN_SECS = 0.002
+
+class Construct:
+	def __init__(self, name, unit, mode="line"):
+		self.name = name
+		self.unit = unit
+		self.mode = mode
+
+	# Int -> [String]
+	def doc(self, n):
+		if self.mode == "chapter":
+			return HEADER + [self.unit] * n
+		return HEADER + [self.unit * n]
+
+	def params(self):
+		return {"name": self.name, "unit": self.unit, "mode": self.mode}
+
+# Known troublemakers, checked before the random ones
+SEEDS = [
+	Construct("unclosed-italics", "*a "),
+	Construct("unclosed-dialog", "|a "),
+	Construct("backticks", "`"),
+	Construct("slash-exceptions", "a/b "),
+	Construct("dashquote-tags", ">a |b|c> "),
+	Construct("escapes", "\\\\a"),
+	Construct("block-comments", "a /*b*/ "),
+	Construct("paragraph-lines", "a b c", "chapter"),
+	Construct("dialog-lines", "|a b|A>", "chapter"),
+	Construct("mergeable-italics", "*a* *b* "),
+]
+
+# Seconds to parse lines, best of repeat, and whether the parse failed.
+# Failing inputs still count: an error reached late can cost as much as a
+# successful parse.
+def parse_time(lines, repeat):
+	best = None
+	failed = False
+	for _ in range(repeat):
+		start = time.perf_counter()
+		try:
+			with contextlib.redirect_stdout(io.StringIO()):
+				P.parse(lines)
+		except Exception:
+			failed = True
+		secs = time.perf_counter() - start
+		best = secs if best is None else min(best, secs)
+	return (best, failed)
+
+# Doubles n until one parse takes longer than budget or n hits max_n.
+# Construct -> [(Int, Float, Bool)]
+def measure(c, budget, repeat, start_n=16, max_n=1 << 16):
+	points = []
+	n = start_n
+	while n <= max_n:
+		(secs, failed) = parse_time(c.doc(n), repeat)
+		points.append((n, secs, failed))
+		if secs > budget:
+			break
+		n *= 2
+	return points
+
+# Least-squares slope of log(secs) over log(n), on the timings big enough to
+# mean something
+def slope(points):
+	pts = [(math.log(n), math.log(secs)) for (n, secs, _) in points if secs >= MIN_SECS]
+	if len(pts) < 3:
+		return None
+	mx = sum(x for (x, _) in pts) / len(pts)
+	my = sum(y for (_, y) in pts) / len(pts)
+	num = sum((x - mx) * (y - my) for (x, y) in pts)
+	den = sum((x - mx) ** 2 for (x, _) in pts)
+	return num / den if den else None
+
+def superlinear(c, budget, repeat, threshold):
+	s = slope(measure(c, budget, repeat))
+	return s is not None and s > threshold
+
+# Drops characters from the unit one at a time for as long as what's left
+# still scales badly
+def minimize(c, budget, repeat, threshold):
+	unit = c.unit
+	shrunk = True
+	while shrunk:
+		shrunk = False
+		for i in range(len(unit)):
+			cand = Construct(c.name, unit[:i] + unit[i+1:], c.mode)
+			if cand.unit.strip() and superlinear(cand, budget, repeat, threshold):
+				unit = cand.unit
+				shrunk = True
+				break
+	return Construct(c.name, unit, c.mode)
+
+def random_construct(rnd, k):
+	unit = ''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(1, 6)))
+	if not unit.strip():
+		unit += "a"
+	return Construct("random-%d" % k, unit, rnd.choice(["line", "line", "chapter"]))
+
+# Saves a reproducer sized to take about target seconds
+def save_case(c, points, outdir, target):
+	(n, secs, _) = points[-1]
+	for (pn, psecs, _) in points:
+		if psecs >= target:
+			(n, secs) = (pn, psecs)
+			break
+	os.makedirs(outdir, exist_ok=True)
+	fname = os.path.join(outdir, "%s.text" % c.name)
+	with open(fname, "w") as f:
+		f.write("# fuzz case: unit %r repeated %d times (%s), %.3fs\n" % (c.unit, n, c.mode, secs))
+		f.write("\n".join(c.doc(n)) + "\n")
+	return fname
+
+# Returns one result per construct; flagged ones are minimized and, with a
+# cases directory, saved.
+def fuzz(trials, seed, budget, repeat, threshold, casedir=None, target=0.1, log=print):
+	debug = P.DEBUG
+	P.DEBUG = False
+	rnd = random.Random(seed)
+	found = []
+	try:
+		constructs = SEEDS + [random_construct(rnd, k) for k in range(trials)]
+		for c in constructs:
+			points = measure(c, budget, repeat)
+			s = slope(points)
+			res = dict(c.params(), slope=s, flagged=False,
+				points=[{"n": n, "secs": secs, "failed": failed} for (n, secs, failed) in points])
+			if s is not None and s > threshold:
+				small = minimize(c, budget, repeat, threshold)
+				res.update(flagged=True, minimized=small.unit)
+				if casedir:
+					res["case"] = save_case(small, measure(small, budget, repeat), casedir, target)
+				log("SUPERLINEAR %-20s slope %.2f unit %r -> %r" % (c.name, s, c.unit, small.unit))
+			else:
+				log("ok          %-20s slope %s" % (c.name, "%.2f" % s if s is not None else "-"))
+			found.append(res)
+	finally:
+		P.DEBUG = debug
+	return found
@@ -0,0 +1,117 @@
+import os
+import random
+import subprocess
+
+import manuscript
+
+# Generates a local git repo whose history looks like years of writing:
+# stories grow a few paragraphs per commit, old lines get reworded, files are
+# occasionally renamed or moved out of drafts, and new stories start now and
+# then. The commits are streamed straight into git fast-import.
+
+DAY = 24 * 3600
+
+class History:
+	def __init__(self, commits=500, stories=6, words_per_commit=300, edit_lines=3,
+			rename_every=150, years=3, seed=1):
+		self.commits = commits
+		self.stories = stories
+		self.words_per_commit = words_per_commit
+		self.edit_lines = edit_lines
+		self.rename_every = rename_every
+		self.years = years
+		self.seed = seed
+
+	def params(self):
+		return dict(self.__dict__)
+
+def story_header(name):
+	return [':Title:' + name.replace('_', ' ').title(), ':Author:Generator', ':Date:2020', '',
+		'//!!!//', '', '##1 (Chapter 1) start', '']
+
+# Appends roughly `words` words, sometimes starting a new chapter
+def grow(rnd, lines, words, m):
+	count = 0
+	while count < words:
+		if rnd.random() < 0.03:
+			chnum = sum(1 for line in lines if line.startswith('##')) + 1
+			lines += ['//!!!//', '', '##%d (Chapter %d) more' % (chnum, chnum), '']
+		para = manuscript.paragraph(rnd, m)
+		count += manuscript.word_count(para)
+		lines += para + ['']
+
+# Rewords a few existing text lines, the way revising a draft does
+def edit(rnd, lines, n, m):
+	text = [i for (i, line) in enumerate(lines) if line and not line[0] in ':#/']
+	for i in rnd.sample(text, min(n, len(text))):
+		lines[i] = manuscript.sentence(rnd, m) + ' ' + manuscript.sentence(rnd, m)
+
+def data(s):
+	b = s.encode('utf-8')
+	return b'data %d\n' % len(b) + b + b'\n'
+
+# Yields the fast-import stream and records which paths each story had, so
+# the benchmark knows a file with renames to track.
+# (History, {String: [String]}) -> Iterable bytes
+def fast_import_stream(h, renames):
+	rnd = random.Random(h.seed)
+	m = manuscript.Manuscript(tag_density=0.2, comment_density=0.03)
+	start = 1500000000
+	step = max(1, h.years * 365 * DAY // max(1, h.commits))
+	stories = {}
+	nstories = 0
+	for k in range(1, h.commits + 1):
+		ops = []
+		if not stories or (nstories < h.stories and rnd.random() < h.stories / max(1, h.commits) * 2):
+			nstories += 1
+			name = 'story_%02d' % nstories
+			path = ('drafts/draft_' if rnd.random() < 0.3 else 'stories/') + name + '.text'
+			stories[path] = story_header(name)
+			renames[path] = [path]
+		# most commits work on the story started most recently
+		active = list(stories)
+		path = active[-1] if rnd.random() < 0.7 else rnd.choice(active)
+		if h.rename_every and k % h.rename_every == 0:
+			new = rename_target(path, rnd)
+			if new not in stories:
+				ops.append(b'R %s %s\n' % (path.encode(), new.encode()))
+				stories[new] = stories.pop(path)
+				renames[new] = renames.pop(path) + [new]
+				path = new
+		grow(rnd, stories[path], h.words_per_commit, m)
+		edit(rnd, stories[path], h.edit_lines, m)
+		if rnd.random() < 0.05:
+			ops.append(b'M 100644 inline notes/ideas_%d.text\n' % k + data(manuscript.phrase(rnd, 20, 60)))
+		ops.append(b'M 100644 inline %s\n' % path.encode() + data('\n'.join(stories[path]) + '\n'))
+
+		when = start + k * step + rnd.randint(0, step // 2)
+		yield b'commit refs/heads/master\n'
+		yield b'mark :%d\n' % k
+		yield b'committer Bench <bench@example.com> %d +0000\n' % when
+		yield data('edit %d' % k)
+		if k > 1:
+			yield b'from :%d\n' % (k - 1)
+		for op in ops:
+			yield op
+		yield b'\n'
+
+# Drafts move into stories/; stories get a new name
+def rename_target(path, rnd):
+	base = os.path.basename(path)
+	if path.startswith('drafts/'):
+		return 'stories/' + base[len('draft_'):]
+	return 'stories/%s_%s.text' % (base[:-len('.text')].split('_v')[0], 'v%d' % rnd.randint(2, 99))
+
+# Builds the repo in root and returns {final path: [paths, oldest first]}
+def make_repo(h, root):
+	subprocess.check_call(['git', 'init', '-q', root])
+	subprocess.check_call(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=root)
+	renames = {}
+	p = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=root, stdin=subprocess.PIPE)
+	for chunk in fast_import_stream(h, renames):
+		p.stdin.write(chunk)
+	p.stdin.close()
+	if p.wait() != 0:
+		raise Exception("git fast-import failed")
+	subprocess.check_call(['git', 'reset', '-q', '--hard', 'master'], cwd=root)
+	return renames
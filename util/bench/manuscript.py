@@ -0,0 +1,105 @@
+import random
+
+# Synthetic .text manuscripts for the benchmarks. Everything generated here
+# parses cleanly, so the timings measure the parser and not its error paths.
+
+WORDS = ("the a magic river sword tower house cat dog under over quietly walked ran said "
+	"stone light shadow morning empty window far slowly turned held").split()
+SPEAKERS = "ABCDEFGHIJ"
+
+# Inline tags that can nest inside each other. '/' (block) only works at the
+# start of a line and '|' (dialog) is generated separately. A single quote
+# closes '`', so '``' never goes inside it.
+INLINE_TAGS = ['*', '@', '{', '``', '`']
+CLOSE = {'*': '*', '@': '@', '{': '}', '``': "''", '`': "'"}
+
+class Manuscript:
+	def __init__(self, words=100000, chapters=20, tag_density=0.3, dialog_ratio=0.4,
+			depth=2, comment_density=0.05, seed=1):
+		self.words = words
+		self.chapters = chapters
+		self.tag_density = tag_density
+		self.dialog_ratio = dialog_ratio
+		self.depth = depth
+		self.comment_density = comment_density
+		self.seed = seed
+
+	def params(self):
+		return dict(self.__dict__)
+
+def phrase(rnd, lo, hi):
+	return ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(lo, hi)))
+
+# Wraps some words in up to `depth` levels of nested inline tags
+# (Random, Int, [String]) -> String
+def tagged(rnd, depth, used=()):
+	allowed = [t for t in INLINE_TAGS if t not in used and not ('`' in used and t == '``')]
+	if depth <= 0 or not allowed:
+		return phrase(rnd, 1, 4)
+	tag = rnd.choice(allowed)
+	inner = phrase(rnd, 1, 3)
+	if depth > 1:
+		inner += ' ' + tagged(rnd, depth - 1, used + (tag,)) + ' ' + phrase(rnd, 1, 2)
+	return tag + inner + CLOSE[tag]
+
+# One sentence of running text, with inline tags at roughly tag_density
+def sentence(rnd, m):
+	parts = [phrase(rnd, 3, 10)]
+	while rnd.random() < m.tag_density:
+		parts.append(tagged(rnd, rnd.randint(1, max(1, m.depth))))
+		parts.append(phrase(rnd, 1, 5))
+	return ' '.join(parts) + '.'
+
+def with_comment(rnd, m, line):
+	if rnd.random() < m.comment_density:
+		return line + rnd.choice([' #note to self', ' /*draft*/'])
+	return line
+
+# (Random, Manuscript) -> [String]
+def paragraph(rnd, m):
+	if rnd.random() < m.dialog_ratio:
+		speaker = rnd.choice(SPEAKERS)
+		lines = []
+		for _ in range(rnd.randint(1, 3)):
+			lines.append('|%s|%s> %s' % (sentence(rnd, m), speaker, sentence(rnd, m)))
+		return lines
+	return [sentence(rnd, m) + ' ' + sentence(rnd, m) for _ in range(rnd.randint(1, 4))]
+
+def word_count(lines):
+	return sum(len(line.split()) for line in lines)
+
+# Yields the manuscript a line at a time, so even the 5M word sizes are never
+# held in memory here.
+# Manuscript -> Iterable String
+def generate(m):
+	rnd = random.Random(m.seed)
+	yield ':Title:Benchmark %d' % m.words
+	yield ':Author:Generator'
+	yield ':Date:2020'
+	yield ''
+	per_ch = max(1, m.words // max(1, m.chapters))
+	for chnum in range(1, m.chapters + 1):
+		yield '//!!!//'
+		yield ''
+		yield '##%d (Chapter %d) generated' % (chnum, chnum)
+		yield ''
+		count = 0
+		while count < per_ch:
+			if rnd.random() < m.comment_density:
+				yield '# ' + phrase(rnd, 2, 6)
+			if rnd.random() < 0.02:
+				yield '//---//'
+				yield ''
+			elif rnd.random() < 0.03:
+				yield '>' + sentence(rnd, m)
+				yield ''
+			lines = paragraph(rnd, m)
+			count += word_count(lines)
+			for line in lines:
+				yield with_comment(rnd, m, line)
+			yield ''
+
+def write(m, fname):
+	with open(fname, 'w') as f:
+		for line in generate(m):
+			f.write(line + '\n')
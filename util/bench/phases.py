@@ -0,0 +1,47 @@
+from itertools import chain
+
+import parser as P
+
+from timer import Timer
+from results import summarize
+
+# Phases are timed one at a time on the same lines, in the order a build runs
+# them. merge_chunks is called from inside parse_chs, so its time is collected
+# by wrapping it and is also part of the parse_chs figure.
+PHASES = ["remove_comments", "parse_prelude", "parse_chs", "merge_chunks",
+	"render_txt", "render_html", "render_pdf", "render_html_warm"]
+
+# [String] -> {String: Float}
+def run_once(lines):
+	timer = Timer()
+	ctx = P.BuildContext()
+	cleaned = timer.run("remove_comments", P.remove_comments, enumerate(lines, 1))
+	chunks = P.split_chapters(iter(cleaned))
+	(prelude, rest) = timer.run("parse_prelude", P.parse_prelude, next(chunks), ctx)
+
+	merge_chunks = P.merge_chunks
+	P.merge_chunks = timer.wrap("merge_chunks", merge_chunks)
+	try:
+		chs = timer.run("parse_chs", P.parse_chs, chain([rest], chunks), ctx)
+	finally:
+		P.merge_chunks = merge_chunks
+	book = P.Book(prelude, chs, P.resolve_transclusions(ctx.all_chs), {}, ctx)
+
+	timer.run("render_txt", P.Renderer(book, P.render_text_txt, P.render_ch_txt).render)
+	html = P.HTMLRenderer(book, P.render_text_html, P.render_ch_html)
+	timer.run("render_html", html.render)
+	timer.run("render_pdf", P.Renderer(book, P.render_text_pdf, P.render_ch_pdf).render)
+	# a rebuild with every paragraph already in the render cache
+	warm = P.HTMLRenderer(book, P.render_text_html, P.render_ch_html, para_cache=html.used)
+	timer.run("render_html_warm", warm.render)
+	return timer.times
+
+# ([String], Int) -> {String: {String: Float}}
+def bench_lines(lines, repeat):
+	debug = P.DEBUG
+	P.DEBUG = False
+	try:
+		runs = [run_once(lines) for _ in range(repeat)]
+	finally:
+		P.DEBUG = debug
+	return {name: summarize([r.get(name, 0.0) for r in runs]) for name in PHASES}
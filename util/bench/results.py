@@ -0,0 +1,90 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+
+from datetime import datetime
+
+RESULTS_VERSION = 1
+THRESHOLD = 0.10
+# differences under this many seconds are noise whatever the ratio
+MIN_DELTA = 0.002
+
+def git_commit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+			cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def new_results(suite):
+	return {
+		"version": RESULTS_VERSION,
+		"suite": suite,
+		"created": datetime.now().isoformat(timespec='seconds'),
+		"python": platform.python_version(),
+		"machine": platform.machine(),
+		"commit": git_commit(),
+		"runs": []
+	}
+
+def summarize(samples):
+	return {
+		"min": min(samples),
+		"median": statistics.median(samples),
+		"mean": statistics.mean(samples),
+		"samples": samples
+	}
+
+def write_results(fname, results):
+	with open(fname, 'w') as f:
+		json.dump(results, f, indent=1)
+
+def read_results(fname):
+	with open(fname) as f:
+		results = json.load(f)
+	if results.get("version") != RESULTS_VERSION:
+		raise Exception(f"{fname}: unsupported results version {results.get('version')}")
+	return results
+
+# Runs are matched on everything that describes their input
+def run_key(run):
+	return json.dumps(run["input"], sort_keys=True)
+
+# Compares the fastest sample of every phase present in both files.
+# Returns [(input, phase, old, new, ratio, regressed)]
+def compare(old, new, threshold=THRESHOLD):
+	oldruns = {run_key(r): r for r in old["runs"]}
+	rows = []
+	for run in new["runs"]:
+		prev = oldruns.get(run_key(run))
+		if not prev:
+			continue
+		for (phase, stats) in run["phases"].items():
+			if phase not in prev["phases"]:
+				continue
+			a = prev["phases"][phase]["min"]
+			b = stats["min"]
+			ratio = b / a if a > 0 else float('inf') if b > 0 else 1.0
+			regressed = ratio > 1 + threshold and b - a > MIN_DELTA
+			rows.append((run["input"], phase, a, b, ratio, regressed))
+	return rows
+
+def input_label(inp):
+	if "file" in inp:
+		return os.path.basename(inp["file"])
+	return ",".join(f"{k}={v}" for (k, v) in sorted(inp.items()) if k != "seed")
+
+def print_comparison(rows):
+	last = None
+	for (inp, phase, a, b, ratio, regressed) in rows:
+		label = input_label(inp)
+		if label != last:
+			print(label)
+			last = label
+		mark = "  REGRESSION" if regressed else ""
+		print(f"  {phase:<20} {a*1000:10.2f}ms {b*1000:10.2f}ms {ratio:7.2f}x{mark}")
+	nreg = sum(1 for row in rows if row[5])
+	print(f"{len(rows)} phases compared, {nreg} regressed")
+	return nreg
@@ -0,0 +1,43 @@
+import time
+
+# Accumulates seconds per phase name. With exclusive set, time spent in a
+# timed call nested inside another is taken off the outer phase, so the phases
+# add up to the total instead of overlapping.
+class Timer:
+	def __init__(self, exclusive=False):
+		self.times = {}
+		self.exclusive = exclusive
+		self.stack = []
+
+	def add(self, name, secs):
+		self.times[name] = self.times.get(name, 0.0) + secs
+
+	def run(self, name, f, *args, **kwargs):
+		self.stack.append(name)
+		start = time.perf_counter()
+		try:
+			return f(*args, **kwargs)
+		finally:
+			secs = time.perf_counter() - start
+			self.stack.pop()
+			self.add(name, secs)
+			if self.exclusive and self.stack:
+				self.add(self.stack[-1], -secs)
+
+	def wrap(self, name, f):
+		def timed(*args, **kwargs):
+			return self.run(name, f, *args, **kwargs)
+		return timed
+
+	# Times each step of a lazy iterator, for generators that are consumed a
+	# bit at a time
+	def wrap_iter(self, name, f):
+		def timed(*args, **kwargs):
+			it = self.run(name, lambda: iter(f(*args, **kwargs)))
+			while True:
+				try:
+					item = self.run(name, next, it)
+				except StopIteration:
+					return
+				yield item
+		return timed
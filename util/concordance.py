@@ -0,0 +1,298 @@
+import os
+import json
+import argparse
+import sqlite3
+
+import parser as P
+
+# Dialog concordance. Every DIALOG node of every book in the conf is stored
+# in sqlite with its speaker (the I> / Z> / 1> tag), chapter and position, so
+# questions like "all of I's lines in chapters 10-20" or "words per speaker"
+# are answered from indexes instead of by parsing. A book is a project's
+# input file, parsed whole, so projects that select chapters of the same
+# file share it. Books are reparsed only when the file, a file it includes or
+# the parser changed since they were stored.
+#
+#   python3 util/concordance.py update
+#   python3 util/concordance.py lines --speaker I --chapters 10-20
+#   python3 util/concordance.py speakers --proj big
+
+DB_NAME = 'concordance.db'
+SCHEMA_VERSION = 2
+BUSY_TIMEOUT = 30
+DEBUG = False
+
+TABLES = ["books", "chapters", "lines", "schema"]
+
+# chpos is the chapter's place in its book, so chapter ranges are ranges of
+# chpos
+SCHEMA = [
+	"""
+	CREATE TABLE IF NOT EXISTS schema (
+		id INTEGER PRIMARY KEY,
+		version INTEGER
+	)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS books (
+		path TEXT PRIMARY KEY,
+		deps TEXT
+	)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS chapters (
+		book TEXT,
+		num TEXT,
+		chpos INTEGER,
+		label TEXT,
+		PRIMARY KEY (book, num)
+	)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS lines (
+		book TEXT,
+		chapter TEXT,
+		chpos INTEGER,
+		para INTEGER,
+		pos INTEGER,
+		lineno INTEGER,
+		speaker TEXT,
+		words INTEGER,
+		text TEXT
+	)
+	""",
+	"CREATE INDEX IF NOT EXISTS lines_speaker ON lines (speaker, book, chpos)",
+	"CREATE INDEX IF NOT EXISTS lines_book ON lines (book, chpos)",
+]
+
+def debug(*s):
+	if DEBUG:
+		s = ' '.join(map(str,list(s)))
+		print(f"DEBUG:CONCORDANCE:{s}")
+
+def get_schema_version(db):
+	try:
+		fetched = db.execute("SELECT version FROM schema WHERE id = 1").fetchall()
+	except sqlite3.OperationalError:
+		return None
+	return fetched[0][0] if fetched else None
+
+def setup_db(nuke, name=DB_NAME):
+	db = sqlite3.connect(name, timeout=BUSY_TIMEOUT)
+	db.execute("PRAGMA journal_mode=WAL")
+	db.execute("PRAGMA synchronous=NORMAL")
+
+	version = get_schema_version(db)
+	if nuke or version != SCHEMA_VERSION:
+		debug(f"Clearing out db tables (schema {version}, want {SCHEMA_VERSION})...")
+		for table in TABLES:
+			db.execute(f"DROP TABLE IF EXISTS {table}")
+		db.commit()
+
+	for stmt in SCHEMA:
+		db.execute(stmt)
+	db.execute("""
+		INSERT INTO schema (id, version)
+		VALUES (1, ?)
+		ON CONFLICT(id)
+		DO UPDATE SET version=excluded.version
+	""", (SCHEMA_VERSION,))
+	db.commit()
+	return db
+
+# {"project": "path"} for every project with an input
+def conf_books(confdict, projs=None):
+	names = projs or [n for n in confdict if n != 'global']
+	books = dict()
+	for n in names:
+		if 'input' not in confdict.get(n, {}):
+			raise Exception(f"project {n} not found (possibly invalid config)")
+		books[n] = os.path.normpath(confdict[n]['input'])
+	return books
+
+def book_stamps(path, book=None):
+	stamps = {os.path.abspath(path): P.file_stamp(path), os.path.abspath(P.__file__): P.file_stamp(P.__file__)}
+	if book:
+		stamps.update(book.includes)
+	return stamps
+
+def book_fresh(db, path):
+	fetched = db.execute("SELECT deps FROM books WHERE path = ?", (path,)).fetchall()
+	if not fetched:
+		return False
+	deps = json.loads(fetched[0][0])
+	return all(os.path.exists(p) and list(P.file_stamp(p)) == stamp for (p, stamp) in deps.items())
+
+# Text and word count of a dialog, with nested tags flattened. The text is
+# joined as it is in the source, since markup adds no space.
+# Node -> (String, Int)
+def dialog_text(node):
+	parts = []
+	stack = [node]
+	while stack:
+		n = stack.pop()
+		if isinstance(n.content, list):
+			stack.extend(reversed(n.content))
+		elif n.tag == 'REGULAR' and n.content:
+			parts.append(n.content)
+	text = ' '.join(''.join(parts).split())
+	return (text, len(text.split()))
+
+# The dialogs of a paragraph in order, not counting quotes inside dialog
+# Para -> [Node]
+def para_dialogs(para):
+	found = []
+	stack = list(reversed(para))
+	while stack:
+		n = stack.pop()
+		if n.tag == 'DIALOG':
+			found.append(n)
+		elif isinstance(n.content, list):
+			stack.extend(reversed(n.content))
+	return found
+
+def speaker_of(tag):
+	return tag.rstrip('>') if tag else None
+
+# An untagged dialog is said by whoever the rest of its paragraph's dialog
+# is tagged with, as in |Well,| she said, |no.|I>. Paragraphs with no tag or
+# with several speakers leave it unattributed.
+# Chapter -> [(Int, Int, Int, String, Int, String)]
+def chapter_lines(ch):
+	rows = []
+	for (k, para) in enumerate(P.flatten(ch.chunks)):
+		dialogs = para_dialogs(para)
+		tagged = set(speaker_of(d.other) for d in dialogs if d.other)
+		default = tagged.pop() if len(tagged) == 1 else None
+		for (pos, d) in enumerate(dialogs):
+			(text, words) = dialog_text(d)
+			rows.append((k, pos, d.lineno, speaker_of(d.other) or default, words, text))
+	return rows
+
+def store_book(db, path, book, stamps):
+	db.execute("DELETE FROM lines WHERE book = ?", (path,))
+	db.execute("DELETE FROM chapters WHERE book = ?", (path,))
+	chapters = []
+	lines = []
+	for (chpos, ch) in enumerate(book.chs if book else []):
+		chapters.append((path, ch.num, chpos, ch.label))
+		lines += [(path, ch.num, chpos) + row for row in chapter_lines(ch)]
+	db.executemany("INSERT OR REPLACE INTO chapters (book, num, chpos, label) VALUES (?, ?, ?, ?)", chapters)
+	db.executemany("""
+		INSERT INTO lines (book, chapter, chpos, para, pos, lineno, speaker, words, text)
+		VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+	""", lines)
+	db.execute("""
+		INSERT INTO books (path, deps)
+		VALUES (?, ?)
+		ON CONFLICT(path)
+		DO UPDATE SET deps=excluded.deps
+	""", (path, json.dumps(stamps)))
+	db.commit()
+	return len(lines)
+
+# Reparses the books that changed. A book that fails to parse is stored
+# empty, so it isn't retried until it is edited.
+def update(db, paths):
+	for path in sorted(set(paths)):
+		if not os.path.exists(path):
+			P.warn(f"{path} not found, skipping")
+			continue
+		if book_fresh(db, path):
+			debug(f"{path} unchanged")
+			continue
+		try:
+			book = P.read_book({'input': path})
+		except Exception as e:
+			P.warn(f"{path}: {e}")
+			store_book(db, path, None, book_stamps(path))
+			continue
+		n = store_book(db, path, book, book_stamps(path, book))
+		print(f"Indexed {n} dialog lines from {path}")
+
+# The SQL condition for a chapter spec, which is read like parser.py's: a
+# chapter number, a range in book order ("10-20") or a comma separated list
+# of either. A book without the chapters matches nothing.
+# String -> (String, [String])
+def chapter_filter(spec):
+	conds = []
+	args = []
+	for item in spec.split(','):
+		item = item.strip()
+		if '-' in item:
+			(first, last) = [x.strip() for x in item.split('-', 1)]
+			conds.append("""chpos BETWEEN
+				(SELECT chpos FROM chapters c WHERE c.book = lines.book AND c.num = ?) AND
+				(SELECT chpos FROM chapters c WHERE c.book = lines.book AND c.num = ?)""")
+			args += [first, last]
+		else:
+			conds.append("chapter = ?")
+			args.append(item)
+	return ("(" + " OR ".join(conds) + ")", args)
+
+def query_filter(paths, speaker=None, chapters=None):
+	conds = ["book IN (%s)" % ",".join("?" * len(paths))]
+	args = list(paths)
+	if speaker is not None:
+		conds.append("speaker = ?")
+		args.append(speaker_of(speaker))
+	if chapters:
+		(cond, chargs) = chapter_filter(chapters)
+		conds.append(cond)
+		args += chargs
+	return (" AND ".join(conds), args)
+
+# [(String, String, Int, String, String)] in book order
+def get_lines(db, paths, speaker=None, chapters=None):
+	(where, args) = query_filter(paths, speaker, chapters)
+	return db.execute(f"""
+		SELECT book, chapter, lineno, speaker, text
+		FROM lines
+		WHERE {where}
+		ORDER BY book, chpos, para, pos
+	""", args).fetchall()
+
+# [(String, Int, Int)] of speaker, lines and words, most words first
+def get_speakers(db, paths, chapters=None):
+	(where, args) = query_filter(paths, None, chapters)
+	return db.execute(f"""
+		SELECT speaker, COUNT(*), SUM(words)
+		FROM lines
+		WHERE {where}
+		GROUP BY speaker
+		ORDER BY SUM(words) DESC
+	""", args).fetchall()
+
+def main():
+	argpars = argparse.ArgumentParser()
+	argpars.add_argument("cmd", choices=["update", "lines", "speakers"])
+	argpars.add_argument("--conf", default="conf")
+	argpars.add_argument("--proj", help="only these projects' books, separated by commas (default: all)")
+	argpars.add_argument("--speaker", help="lines: only this speaker's, e.g. I or I>")
+	argpars.add_argument("--chapters", help="only these chapters, e.g. 10-20 or 1,4-6")
+	argpars.add_argument("--db", default=DB_NAME)
+	argpars.add_argument("--nuke", action="store_true", help="rebuild the concordance from scratch")
+	argpars.add_argument("--debug", action="store_true")
+	args = argpars.parse_args()
+
+	global DEBUG
+	DEBUG = args.debug
+	P.DEBUG = False
+	confdict = P.read_conf(args.conf)
+	paths = list(conf_books(confdict, args.proj.split(",") if args.proj else None).values())
+	db = setup_db(args.nuke, args.db)
+	try:
+		update(db, paths)
+		if args.cmd == "lines":
+			for (book, chapter, lineno, speaker, text) in get_lines(db, paths, args.speaker, args.chapters):
+				print(f"{book}:{lineno}: [{chapter}] {speaker or '?'}> {text}")
+		elif args.cmd == "speakers":
+			rows = get_speakers(db, paths, args.chapters)
+			print(f"{'speaker':<10} {'lines':>8} {'words':>10}")
+			for (speaker, nlines, words) in rows:
+				print(f"{speaker or '?':<10} {nlines:>8} {words:>10}")
+	finally:
+		db.close()
+
+if __name__ == '__main__':
+	main()
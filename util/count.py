@@ -1,20 +1,45 @@
 
 import git
 import re
-import sqlite3
 import argparse
 import glob
 import os
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 
 from typing import Any
 from datetime import datetime
 from collections import defaultdict, namedtuple
 
+import count_cache
+from count_cache import (setup_db, close_db, to_epoch,
+	get_last_name, put_last_name, get_cached_renames, put_cached_renames,
+	get_cached_counts, put_cached_count, put_daily_count, get_daily_totals, get_daily_rows, clear_daily,
+	get_corpus_head, put_corpus_head, get_file_index, find_indexed_file, put_file_index,
+	add_file_index, remove_file_index)
+
 WORDS_PER_LINE = 11
 USE_CACHE = True
 DEBUG = False 
 DEBUG_CACHE = True
-DB_NAME = 'count_cache.db'
+JOBS = 1
+CHUNKS_PER_JOB = 4
+CORPUS_BATCH = 256
+MEMPROFILE = None
+
+FILTER_LIST = [
+	"isekai_notes_outline.text",
+	"(tiny_ideas).text",
+	"tower_short.text"
+]
+NOMATCH = [
+	"draft",
+	"ideas_",
+	"nonstories/",
+	"learning/" 
+]
 
 def debug(*s):
 	if DEBUG:
@@ -26,11 +51,28 @@ def debug_cache(*s):
 	if DEBUG_CACHE:
 		debug(*s)
 
-def find_file(name):
+# Tracks memory per phase with --memprofile, does nothing otherwise
+def phase(name):
+	return MEMPROFILE.phase(name) if MEMPROFILE else nullcontext()
+
+def file_key(fname):
+	return os.path.basename(fname)[:-len(".text")]
+
+def find_file(name, cache=None):
+	indexed = find_indexed_file(cache, name) or []
+	for path in [p for p in indexed if not os.path.exists(p)]:
+		debug_cache(f"Dropping {path} from file index, it no longer exists")
+		remove_file_index(cache, path)
+		indexed.remove(path)
+	if len(indexed) == 1:
+		debug_cache(f"Found {name} in file index: {indexed[0]}")
+		return indexed[0]
+
 	pattern = f'**/{name}.text'
 	result = glob.glob(pattern, recursive=True)
 
 	if len(result) == 1:
+		add_file_index(cache, result[0], file_key(result[0]))
 		return result[0]
 
 	else:
@@ -84,27 +126,28 @@ def count_lines(lines):
 	#prevfile = (numlines,hs, result)
 	return result
 
-def diff_lines(prevlines, lines2, prevd=None):
-	if not prevd:
-		prevd = defaultdict(int)
-		for line in prevlines:
-			line = strip_formatting(line)
-			if line:
-				prevd[line] += 1
-
-	d2 = defaultdict(int)
-	for line in lines2:
+def line_multiset(lines):
+	d = defaultdict(int)
+	for line in lines:
 		line = strip_formatting(line)
 		if line:
-			d2[line] += 1
+			d[line] += 1
+	return d
 
+def diff_multisets(prevd, d2):
 	diff = 0
-
 	for line,ct in prevd.items():
 		if line not in d2:
 			diff += ct
 			#print(f"EDITED {line}")
+	return diff
 
+def diff_lines(prevlines, lines2, prevd=None):
+	if not prevd:
+		prevd = line_multiset(prevlines)
+
+	d2 = line_multiset(lines2)
+	diff = diff_multisets(prevd, d2)
 	return (diff, d2)
 
 def mkpairs(ls):
@@ -147,139 +190,36 @@ def get_renames(repo, file):
 			break
 	return renames
 
-def setup_db(nuke):
-	if USE_CACHE:
-		db = sqlite3.connect(DB_NAME)
-		cursor = db.cursor()
-		
-		if nuke:
-			debug_cache("Clearing out db tables...")
-			cursor.execute("DROP TABLE IF EXISTS counts")
-			cursor.execute("DROP TABLE IF EXISTS renames")
-			cursor.execute("DROP TABLE IF EXISTS last")
-			db.commit()
-
-		debug_cache("Creating db tables...")
-		cursor.execute("""
-			CREATE TABLE IF NOT EXISTS counts (
-				file TEXT,
-				added INTEGER,
-				edited INTEGER,
-				date DATE,
-				PRIMARY KEY (file, date)
-			)
-		""")
-		
-		cursor.execute("""
-			CREATE TABLE IF NOT EXISTS renames (
-				orig TEXT PRIMARY KEY,
-				prev TEXT
-			)
-		""")
-
-		cursor.execute("""
-			CREATE TABLE IF NOT EXISTS last (
-				id INTEGER PRIMARY KEY,
-				name TEXT
-			)
-		""")
-
-
-		return (db,cursor)
-	else:
-		debug_cache("No setup to do, caching is disabled")
-		return (None,None)
-
-def get_last_name(cache, name):
-	if USE_CACHE:
-		fetched = cache.execute("""
-			SELECT name
-			FROM last
-			WHERE id = 1
-		""").fetchall()
-		if fetched and fetched[0]:
-			return fetched[0][0]
-	else:
-		return name
-
-def put_last_name(cache, name):
-	if USE_CACHE:
-		cache.execute("""
-			INSERT INTO last (id, name) 
-			VALUES (?, ?)
-			ON CONFLICT(id) 
-			DO UPDATE SET name=excluded.name
-		""", (1, name))
-
-def get_cached_renames(cache, file):
-	if USE_CACHE:
-		fetched = cache.execute("""
-			select prev
-			from renames
-			where orig = ?
-		""", (file,)).fetchall()
-		if fetched:
-			renames = fetched[0][0]
-			debug_cache(f"Got cached renames: {renames}")
-			renames = re.split(",", renames) if renames else None
-			return renames
-		else:
-			debug_cache("Didn't find cached renames")
-
-
-	return None
-
-def put_cached_renames(cache, file, renames):
-	if USE_CACHE:
-		debug_cache(f"Storing renames for {file}: {renames}")
-		renames_str = ",".join(renames)
-		cache.execute("""
-			INSERT OR IGNORE INTO renames (orig, prev) 
-			VALUES (?, ?)
-			""", (file,renames_str))
-
-
-def get_cached_count(cache, file, date):
-	if USE_CACHE:
-		res = cache.execute("""
-			select added, edited
-			from counts
-			where date = ? and file = ?
-		""", (date, file)).fetchall()
-		res = res[0] if res and len(res)>0 else None
-		debug_cache(f"Pulling cached count for {file},{date}: {res}")
-		return res
-	else:
-		return None
-	
-
-
-def put_cached_count(cache, file, date, num_added, num_edited_raw):
-	if USE_CACHE:
-		debug_cache(f"Inserting into cache {file},{date}: {num_added}, {num_edited_raw}")
-		cache.execute("""
-				INSERT OR IGNORE INTO counts (file, date, added, edited) 
-				VALUES (?, ?, ?, ?)
-		""", (file,date,num_added,num_edited_raw))
-
-def close_db(db):
-	if USE_CACHE:
-		debug_cache("Closing db...")
-		db.commit()
-		db.close()
-
-
-Entry = namedtuple("Entry", ["lines","count","date","filename","isdirty"])
+Entry = namedtuple("Entry", ["multiset","count","date","filename","isdirty"])
 
 def split_lines(s):
 	return s.splitlines()
 
+# String -> Int
+def count_words(contents):
+	return count_lines(split_lines(contents))[1]
+
+# String -> (Int, {String: Int})
+def count_contents(contents):
+	lines = split_lines(contents)
+	(replaced, ct) = count_lines(lines)
+	return (ct, line_multiset(replaced))
+
+# Each revision is counted independently, so the expensive part can be farmed
+# out to worker processes. Only the pairwise multiset diff has to be serial.
+def count_revs(contents, jobs, func=count_contents):
+	if jobs <= 1 or len(contents) < 2:
+		return list(map(func, contents))
+	chunksize = max(1, len(contents) // (jobs * CHUNKS_PER_JOB))
+	debug(f"Counting {len(contents)} revisions on {jobs} workers, chunksize {chunksize}")
+	with ProcessPoolExecutor(max_workers=jobs) as pool:
+		return list(pool.map(func, contents, chunksize=chunksize))
+
 def count_file(f):
 	date = datetime.now()
 	contents = open(f, 'r').read()
-	lines = split_lines(contents)
-	(replaced, ct) = count_lines(lines)
-	return Entry(replaced, ct, date, f, True)
+	(ct, d) = count_contents(contents)
+	return Entry(d, ct, date, f, True)
 
 def print_cols(lst):
 	widths = [max(len(str(x)) for x in col) for col in zip(*lst) ]
@@ -293,98 +233,215 @@ def resolve_name(cache : Any, name : str) -> str:
 		raise Exception("Name to track needed and none found in cache or cache disabled.")
 	put_last_name(cache,name)
 	if ".text" not in name:
-		name = find_file(name)
+		name = find_file(name, cache)
 	return name
 
 def run_count(cache, name):
 	repo = git.Repo(os.environ["STORY_ROOT"])
-	name = resolve_name(cache, name)
-	all_names = get_cached_renames(cache, name)
-	if not all_names:
-		all_names = get_renames(repo,name)
-		put_cached_renames(cache, name, all_names)
-	print(f'Tracking {", ".join(all_names)}')
-	commits = list(repo.iter_commits(paths=all_names))
-	revs = []
-	for commit in reversed(commits):
-		date = commit.committed_datetime
-		blob = None
-		for f in reversed(all_names):
-			try:
-				blob = commit.tree / f
-				break
-			except KeyError:
-				pass
-		if not blob:
-			debug(f"WARNING: Couldn't find {f} among {all_names} at {date}")
+	with phase("history"):
+		name = resolve_name(cache, name)
+		all_names = get_cached_renames(cache, name)
+		if not all_names:
+			all_names = get_renames(repo,name)
+			put_cached_renames(cache, name, all_names)
+		print(f'Tracking {", ".join(all_names)}')
+		cached_counts = get_cached_counts(cache, all_names)
+		commits = list(repo.iter_commits(paths=all_names))
+	with phase("blob_read"):
+		revs = []
+		for commit in reversed(commits):
+			date = commit.committed_datetime
+			blob = None
+			for f in reversed(all_names):
+				try:
+					blob = commit.tree / f
+					break
+				except KeyError:
+					pass
+			if not blob:
+				debug(f"WARNING: Couldn't find {f} among {all_names} at {date}")
+				continue
+			revs.append((date, slurp_commit(blob), f))
+
+	with phase("count"):
+		counted = []
+		results = count_revs([r[1] for r in revs], JOBS)
+		for (r, (ct, d)) in zip(revs, results):
+			date = r[0]
+			file = r[2]
+			entry = Entry(d,ct,date,file,False)
+			counted.append(entry)
+			debug(entry.date,entry.count)
+		counted.append(count_file(file))
+	with phase("diff"):
+		zipped = mkpairs(counted)
+		zipped.insert(0,(None,counted[0]))
+		data = []
+		for (a,b) in zipped:
+			date = b.date
+			file = b.filename
+			cached = cached_counts.get((file, to_epoch(date))) if not b.isdirty else None
+			if cached:
+				(count,diff) = cached
+			else:
+				if a is not None:
+					diff = diff_multisets(a.multiset, b.multiset)
+					count = b.count - a.count
+				else:
+					diff = 0
+					count = b.count
+				if not cached and not b.isdirty:
+					put_cached_count(cache, file, date, count, diff)
+
+			date = b.date.strftime('%Y-%m-%d')
+			if count == 0 and b.isdirty:
+				debug("No difference in current rev. Skipping line.")
+				continue
+			data.append((date, b.count, f"{count} words added", f"{diff} lines edited"))
+			#print(f"{date} {b.count}, {count} words added, {diff} lines edited")
+	print_cols(data)
+
+def is_counted(fname):
+	if not fname.endswith(".text"):
+		return False
+	if any(map(lambda m: m in fname,NOMATCH)):
+		return False
+	return fname not in FILTER_LIST
+
+# Commit -> [(String, Blob, Blob)]
+def touched_files(commit):
+	if not commit.parents:
+		return [(b.path, None, b) for b in commit.tree.traverse() if b.type == 'blob' and is_counted(b.path)]
+	touched = []
+	for diff in commit.parents[0].diff(commit):
+		if diff.deleted_file or not is_counted(diff.b_path):
 			continue
-		revs.append((date, slurp_commit(blob), f))
-
-	counted = []
-	for r in revs:
-		date = r[0]
-		contents = r[1]
-		file = r[2]
-		lines = split_lines(contents)
-		(ls,ct) = count_lines(lines)
-		entry = Entry(ls,ct,date,file,False)
-		counted.append(entry)
-		debug(entry.date,entry.count)
-	counted.append(count_file(file))
-	zipped = mkpairs(counted)
-	zipped.insert(0,(None,counted[0]))
-	prevd = None
+		touched.append((diff.b_path, diff.a_blob, diff.b_blob))
+	return touched
+
+# Walks the history once, first parent only, and yields one
+# (file, date, added, edited) record per counted file touched by each commit.
+# Blobs are counted in batches so each batch can go through count_revs.
+def walk_corpus(repo, since=None):
+	rev = f"{since}..HEAD" if since else "HEAD"
+	commits = list(repo.iter_commits(rev, first_parent=True))
+	commits.reverse()
+	debug(f"Walking {len(commits)} commits")
+	counted = {}
+	for i in range(0, len(commits), CORPUS_BATCH):
+		batch = [(c, touched_files(c)) for c in commits[i:i+CORPUS_BATCH]]
+		blobs = {}
+		for (_, touched) in batch:
+			for (_, a, b) in touched:
+				for blob in (a, b):
+					if blob is not None and blob.hexsha not in counted:
+						blobs[blob.hexsha] = blob
+		shas = list(blobs)
+		results = count_revs([slurp_commit(blobs[k]) for k in shas], JOBS)
+		counted.update(zip(shas, results))
+		for (commit, touched) in batch:
+			date = commit.committed_datetime
+			for (path, a, b) in touched:
+				(ct, d) = counted[b.hexsha]
+				if a is None:
+					yield (path, date, ct, 0)
+				else:
+					(prevct, prevd) = counted[a.hexsha]
+					yield (path, date, ct - prevct, diff_multisets(prevd, d))
+		# anything older than this batch will only be needed again if a file
+		# goes untouched for a whole batch, in which case it's simply re-read
+		keep = set(b.hexsha for (_, touched) in batch for (_, _, b) in touched)
+		counted = {k: v for (k, v) in counted.items() if k in keep}
+
+# Brings the counts and daily tables up to date with HEAD and returns the
+# per-(file, day) totals of the commits walked this time.
+def update_corpus(cache):
+	repo = git.Repo(os.environ["STORY_ROOT"])
+	head = repo.head.commit.hexsha
+	since = get_corpus_head(cache)
+	if since and not (repo.is_valid_object(since, 'commit') and repo.is_ancestor(since, head)):
+		debug(f"Cached corpus head {since} is no longer in history, recounting")
+		clear_daily(cache)
+		since = None
+	daily = defaultdict(lambda: [0, 0])
+	for (file, date, added, edited) in walk_corpus(repo, since):
+		put_cached_count(cache, file, date, added, edited)
+		day = date.strftime('%Y-%m-%d')
+		daily[(file, day)][0] += added
+		daily[(file, day)][1] += edited
+	for ((file, day), (added, edited)) in daily.items():
+		put_daily_count(cache, file, day, added, edited)
+	put_corpus_head(cache, head)
+	return daily
+
+def run_corpus(cache):
+	with phase("walk"):
+		daily = update_corpus(cache)
+	if cache:
+		totals = get_daily_totals(cache)
+	else:
+		bydate = defaultdict(lambda: [0, 0, 0])
+		for ((file, day), (added, edited)) in daily.items():
+			bydate[day][0] += added
+			bydate[day][1] += edited
+			bydate[day][2] += 1
+		totals = [(day, *vals) for (day, vals) in sorted(bydate.items())]
 	data = []
-	for (a,b) in zipped:
-		date = b.date
-		file = b.filename
-		cached = get_cached_count(cache, file, date) if not b.isdirty else None
-		if cached:
-			(count,diff) = cached
-		else:
-			if a is not None:
-				(diff,d) = diff_lines(a.lines, b.lines, prevd)
-				prevd = d
-				count = b.count - a.count
-			else:
-				(diff,d) = (0,None)
-				count = b.count
-			if not cached and not b.isdirty:
-				put_cached_count(cache, file, date, count, diff)
-
-		date = b.date.strftime('%Y-%m-%d')
-		if count == 0 and b.isdirty:
-			debug("No difference in current rev. Skipping line.")
+	for (day, added, edited, files) in totals:
+		data.append((day, f"{added} words added", f"{edited} lines edited", f"{files} files"))
+	if data:
+		print_cols(data)
+
+def hash_contents(contents):
+	return hashlib.sha1(contents.encode('utf-8')).hexdigest()
+
+# Returns {path: count} for every counted file, only reading files whose
+# (mtime, size) changed and only recounting files whose contents changed.
+def count_indexed(cache, files):
+	index = get_file_index(cache)
+	counts = {}
+	stale = []
+	for fname in files:
+		cached = index.get(fname)
+		if not is_counted(fname):
+			if not cached:
+				add_file_index(cache, fname, file_key(fname))
 			continue
-		data.append((date, b.count, f"{count} words added", f"{diff} lines edited"))
-		#print(f"{date} {b.count}, {count} words added, {diff} lines edited")
-	print_cols(data)
+		st = os.stat(fname)
+		if cached and cached.count is not None and (cached.mtime, cached.size) == (st.st_mtime_ns, st.st_size):
+			counts[fname] = cached.count
+			continue
+		contents = open(fname,"r").read()
+		hash = hash_contents(contents)
+		if cached and cached.count is not None and cached.hash == hash:
+			counts[fname] = cached.count
+			put_file_index(cache, fname, file_key(fname), st.st_mtime_ns, st.st_size, hash, cached.count)
+			continue
+		stale.append((fname, st, hash, contents))
+
+	debug_cache(f"Recounting {len(stale)} of {len(counts) + len(stale)} files")
+	results = count_revs([x[3] for x in stale], JOBS, count_words)
+	for ((fname, st, hash, _), ct) in zip(stale, results):
+		counts[fname] = ct
+		put_file_index(cache, fname, file_key(fname), st.st_mtime_ns, st.st_size, hash, ct)
+
+	for path in set(index) - set(files):
+		remove_file_index(cache, path)
+	return counts
 
-def count_all():
-	filter_list = [
-		"isekai_notes_outline.text",
-		"(tiny_ideas).text",
-		"tower_short.text"
-	]
-	nomatch = [
-		"draft",
-		"ideas_",
-		"nonstories/",
-		"learning/" 
-	]
+def count_all(cache):
 	pattern = '**/*.text'
-	files = glob.glob(pattern, recursive=True)
+	with phase("files"):
+		files = glob.glob(pattern, recursive=True)
+	with phase("count"):
+		counts = count_indexed(cache, files)
 	count = 0
 	lst = []
 	maxlen = 0
 	for fname in files:
-		if any(map(lambda m: m in fname,nomatch)):
+		if fname not in counts:
 			continue
-		if fname in filter_list:
-			continue
-		lines = split_lines(open(fname,"r").read())
-		(_,ct) = count_lines(lines)
-		name = fname.split("/")[-1].split(".")[0]
+		ct = counts[fname]
 		lst.append((fname,ct))
 		maxlen = max(len(fname),maxlen)
 		count += ct
@@ -396,16 +453,64 @@ def count_all():
 		print(f'{name:<{maxlen+1}}{ct}')
 
 
+def run_stats(cache, window, csvfile, jsonfile):
+	if not cache:
+		raise Exception("stats reads the count cache and can't run with --no-cache")
+	import count_stats
+	with phase("walk"):
+		update_corpus(cache)
+	rows = get_daily_rows(cache)
+	if not rows:
+		print("No history to analyse")
+		return
+	with phase("stats"):
+		stats = count_stats.compute_stats(rows, datetime.now().date(), window)
+	(daily, weekly, streak, projects) = stats
+
+	print(f"{int(daily.added.sum())} words added, {int(daily.edited.sum())} lines edited over {len(daily.days)} days")
+	print(f"{int((daily.added > 0).sum())} active days, longest streak {streak.longest} days (from {streak.longest_start}), current streak {streak.current} days")
+	print()
+	data = [("week", "added", "edited")]
+	for (w, a, e) in zip(weekly.weeks, weekly.added, weekly.edited):
+		data.append((w, a, e))
+	print_cols(data)
+	print()
+	data = [("day", "added", "edited", f"{window}-day", "edit/add")]
+	for (d, a, e, r, q) in list(zip(daily.days, daily.added, daily.edited, daily.rolling, daily.ratio))[-2*window:]:
+		data.append((d, a, e, r, count_stats.ratio_str(q)))
+	print_cols(data)
+	print()
+	data = [("file", "added", "edited", "days", "first", "last")]
+	order = projects.added.argsort()
+	for i in order:
+		data.append((projects.files[i], projects.added[i], projects.edited[i], projects.active[i], projects.first[i], projects.last[i]))
+	print_cols(data)
+
+	if csvfile:
+		count_stats.write_csv(csvfile, daily)
+	if jsonfile:
+		count_stats.write_json(jsonfile, stats, window)
+
 def get_args():
-	global USE_CACHE
+	global USE_CACHE, JOBS
 	argpars = argparse.ArgumentParser()
 	argpars.add_argument("file_to_track",default="dummy",nargs='?')
 	argpars.add_argument("--nuke",action='store_true')
 	argpars.add_argument("--no-cache",action='store_true')
 	argpars.add_argument("--all-count",action='store_true')
+	argpars.add_argument("--corpus",action='store_true',help="daily totals for every story from one walk of the history")
+	argpars.add_argument("-j", "--jobs",type=int,default=JOBS,help="worker processes for counting revisions (0 = one per core)")
+	argpars.add_argument("--stats",action='store_true',help="daily and rolling word count stats for the whole corpus")
+	argpars.add_argument("--window",type=int,default=7,help="rolling window in days for --stats")
+	argpars.add_argument("--csv",help="--stats: write the daily series to this file")
+	argpars.add_argument("--json",help="--stats: write all stats to this file")
+	argpars.add_argument("--memprofile",action='store_true',help="report peak and retained memory per phase and where it was allocated (worker processes aren't traced)")
 	args = argpars.parse_args()
+	if args.window < 1:
+		argpars.error("--window must be at least 1 day")
 	if args.no_cache:
 		USE_CACHE = False
+	JOBS = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
 	if args.file_to_track == "dummy":
 		args.file_to_track = None
 	if args.nuke and not USE_CACHE:
@@ -414,15 +519,28 @@ def get_args():
 	return args
 
 def main():
+	global MEMPROFILE
 	args = get_args()
-	if args.all_count:
-		count_all()
-		return
-	(db, cache) = setup_db(args.nuke)
+	count_cache.DEBUG = DEBUG and DEBUG_CACHE
+	if args.memprofile:
+		import memprofile
+		MEMPROFILE = memprofile.MemoryProfile()
+	with phase("open_cache"):
+		cache = setup_db(args.nuke) if USE_CACHE else None
 	try:
-		run_count(cache, args.file_to_track)
+		if args.all_count:
+			count_all(cache)
+		elif args.corpus:
+			run_corpus(cache)
+		elif args.stats:
+			run_stats(cache, args.window, args.csv, args.json)
+		else:
+			run_count(cache, args.file_to_track)
 	finally:
-		close_db(db)
+		close_db(cache)
+		if MEMPROFILE:
+			MEMPROFILE.stop()
+			MEMPROFILE.report("count.py")
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,324 @@
+import re
+import sqlite3
+
+from collections import namedtuple
+
+DB_NAME = 'count_cache.db'
+SCHEMA_VERSION = 2
+COMMIT_EVERY = 1000
+BUSY_TIMEOUT = 30
+DEBUG = False
+
+TABLES = ["counts", "renames", "last", "daily", "corpus", "files", "schema"]
+
+# Dates are stored as epoch seconds (counts) or ISO days (daily) so rows
+# written by different versions of python/sqlite3 still compare equal.
+SCHEMA = [
+	"""
+	CREATE TABLE IF NOT EXISTS schema (
+		id INTEGER PRIMARY KEY,
+		version INTEGER
+	)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS counts (
+		file TEXT,
+		date INTEGER,
+		added INTEGER,
+		edited INTEGER,
+		PRIMARY KEY (file, date)
+	)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS renames (
+		orig TEXT PRIMARY KEY,
+		prev TEXT
+	)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS last (
+		id INTEGER PRIMARY KEY,
+		name TEXT
+	)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS daily (
+		file TEXT,
+		day TEXT,
+		added INTEGER,
+		edited INTEGER,
+		PRIMARY KEY (file, day)
+	)
+	""",
+	"CREATE INDEX IF NOT EXISTS daily_day ON daily (day)",
+	"""
+	CREATE TABLE IF NOT EXISTS corpus (
+		id INTEGER PRIMARY KEY,
+		head TEXT
+	)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS files (
+		path TEXT PRIMARY KEY,
+		name TEXT,
+		mtime INTEGER,
+		size INTEGER,
+		hash TEXT,
+		count INTEGER
+	)
+	""",
+	"CREATE INDEX IF NOT EXISTS files_name ON files (name)",
+]
+
+def debug(*s):
+	if DEBUG:
+		s = ' '.join(map(str,list(s)))
+		print(f"DEBUG:CACHE:{s}")
+
+def to_epoch(date):
+	return int(date.timestamp())
+
+# Wraps the connection so writes can be queued and sent with executemany.
+# Queued statements are flushed in order before any read, and at least every
+# COMMIT_EVERY rows so an interrupted run keeps most of its work. Every flush
+# commits, so the write lock is only held while the queue is written out and
+# other runs can use the cache in between.
+class CountCache:
+	def __init__(self, db):
+		self.db = db
+		self.pending = []
+		self.npending = 0
+
+	def execute(self, sql, args=()):
+		self.flush()
+		return self.db.execute(sql, args)
+
+	def queue(self, sql, row):
+		if self.pending and self.pending[-1][0] == sql:
+			self.pending[-1][1].append(row)
+		else:
+			self.pending.append((sql, [row]))
+		self.npending += 1
+		if self.npending >= COMMIT_EVERY:
+			self.commit()
+
+	def flush(self):
+		if not self.pending:
+			return
+		for (sql, rows) in self.pending:
+			self.db.executemany(sql, rows)
+		self.pending = []
+		self.npending = 0
+		debug("Committing...")
+		self.db.commit()
+
+	def commit(self):
+		self.flush()
+
+	def close(self):
+		self.commit()
+		self.db.close()
+
+def get_schema_version(db):
+	try:
+		fetched = db.execute("SELECT version FROM schema WHERE id = 1").fetchall()
+	except sqlite3.OperationalError:
+		return None
+	return fetched[0][0] if fetched else None
+
+def setup_db(nuke, name=DB_NAME):
+	db = sqlite3.connect(name, timeout=BUSY_TIMEOUT)
+	db.execute("PRAGMA journal_mode=WAL")
+	db.execute("PRAGMA synchronous=NORMAL")
+
+	version = get_schema_version(db)
+	# an up to date cache is opened without writing, so a run already using
+	# it doesn't lock this one out
+	if not nuke and version == SCHEMA_VERSION:
+		return CountCache(db)
+	debug(f"Clearing out db tables (schema {version}, want {SCHEMA_VERSION})...")
+	for table in TABLES:
+		db.execute(f"DROP TABLE IF EXISTS {table}")
+	db.commit()
+
+	debug("Creating db tables...")
+	for stmt in SCHEMA:
+		db.execute(stmt)
+	db.execute("""
+		INSERT INTO schema (id, version)
+		VALUES (1, ?)
+		ON CONFLICT(id)
+		DO UPDATE SET version=excluded.version
+	""", (SCHEMA_VERSION,))
+	db.commit()
+	return CountCache(db)
+
+def close_db(cache):
+	if cache:
+		debug("Closing db...")
+		cache.close()
+
+def get_last_name(cache, name):
+	if cache:
+		fetched = cache.execute("""
+			SELECT name
+			FROM last
+			WHERE id = 1
+		""").fetchall()
+		if fetched and fetched[0]:
+			return fetched[0][0]
+	else:
+		return name
+
+def put_last_name(cache, name):
+	if cache:
+		cache.queue("""
+			INSERT INTO last (id, name)
+			VALUES (?, ?)
+			ON CONFLICT(id)
+			DO UPDATE SET name=excluded.name
+		""", (1, name))
+
+def get_cached_renames(cache, file):
+	if cache:
+		fetched = cache.execute("""
+			select prev
+			from renames
+			where orig = ?
+		""", (file,)).fetchall()
+		if fetched:
+			renames = fetched[0][0]
+			debug(f"Got cached renames: {renames}")
+			renames = re.split(",", renames) if renames else None
+			return renames
+		else:
+			debug("Didn't find cached renames")
+
+	return None
+
+def put_cached_renames(cache, file, renames):
+	if cache:
+		debug(f"Storing renames for {file}: {renames}")
+		renames_str = ",".join(renames)
+		cache.queue("""
+			INSERT OR IGNORE INTO renames (orig, prev)
+			VALUES (?, ?)
+		""", (file,renames_str))
+
+# Returns {(file, epoch): (added, edited)} for every cached revision of files
+def get_cached_counts(cache, files):
+	res = {}
+	if cache and files:
+		files = sorted(set(files))
+		fetched = cache.execute(f"""
+			select file, date, added, edited
+			from counts
+			where file in ({",".join("?" * len(files))})
+		""", files).fetchall()
+		for (file, date, added, edited) in fetched:
+			res[(file, date)] = (added, edited)
+		debug(f"Pulled {len(res)} cached counts for {files}")
+	return res
+
+def put_cached_count(cache, file, date, num_added, num_edited_raw):
+	if cache:
+		cache.queue("""
+			INSERT OR IGNORE INTO counts (file, date, added, edited)
+			VALUES (?, ?, ?, ?)
+		""", (file,to_epoch(date),num_added,num_edited_raw))
+
+def put_daily_count(cache, file, day, num_added, num_edited):
+	if cache:
+		cache.queue("""
+			INSERT INTO daily (file, day, added, edited)
+			VALUES (?, ?, ?, ?)
+			ON CONFLICT(file, day)
+			DO UPDATE SET added=added+excluded.added, edited=edited+excluded.edited
+		""", (file, day, num_added, num_edited))
+
+def get_daily_totals(cache):
+	if cache:
+		return cache.execute("""
+			SELECT day, SUM(added), SUM(edited), COUNT(file)
+			FROM daily
+			GROUP BY day
+			ORDER BY day
+		""").fetchall()
+	return []
+
+def get_daily_rows(cache):
+	if cache:
+		return cache.execute("""
+			SELECT file, day, added, edited
+			FROM daily
+			ORDER BY day
+		""").fetchall()
+	return []
+
+def clear_daily(cache):
+	if cache:
+		cache.queue("DELETE FROM daily", ())
+
+def get_corpus_head(cache):
+	if cache:
+		fetched = cache.execute("""
+			SELECT head
+			FROM corpus
+			WHERE id = 1
+		""").fetchall()
+		if fetched and fetched[0]:
+			return fetched[0][0]
+	return None
+
+def put_corpus_head(cache, head):
+	if cache:
+		cache.queue("""
+			INSERT INTO corpus (id, head)
+			VALUES (?, ?)
+			ON CONFLICT(id)
+			DO UPDATE SET head=excluded.head
+		""", (1, head))
+
+FileStat = namedtuple("FileStat", ["path","mtime","size","hash","count"])
+
+def get_file_index(cache):
+	if cache:
+		fetched = cache.execute("""
+			SELECT path, mtime, size, hash, count
+			FROM files
+		""").fetchall()
+		return {row[0]: FileStat(*row) for row in fetched}
+	return {}
+
+def find_indexed_file(cache, name):
+	if cache:
+		fetched = cache.execute("""
+			SELECT path
+			FROM files
+			WHERE name = ?
+		""", (name,)).fetchall()
+		return [row[0] for row in fetched]
+	return None
+
+def put_file_index(cache, path, name, mtime, size, hash, count):
+	if cache:
+		cache.queue("""
+			INSERT INTO files (path, name, mtime, size, hash, count)
+			VALUES (?, ?, ?, ?, ?, ?)
+			ON CONFLICT(path)
+			DO UPDATE SET mtime=excluded.mtime, size=excluded.size, hash=excluded.hash, count=excluded.count
+		""", (path, name, mtime, size, hash, count))
+
+# Records a path without touching the stats of one already indexed
+def add_file_index(cache, path, name):
+	if cache:
+		cache.queue("""
+			INSERT INTO files (path, name)
+			VALUES (?, ?)
+			ON CONFLICT(path)
+			DO NOTHING
+		""", (path, name))
+
+def remove_file_index(cache, path):
+	if cache:
+		cache.queue("DELETE FROM files WHERE path = ?", (path,))
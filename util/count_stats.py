@@ -0,0 +1,114 @@
+import numpy as np
+
+from collections import namedtuple
+
+ROLLING_WINDOW = 7
+
+Series = namedtuple("Series", ["files","days","added","edited"])
+Daily = namedtuple("Daily", ["days","added","edited","rolling","ratio"])
+Weekly = namedtuple("Weekly", ["weeks","added","edited"])
+Streaks = namedtuple("Streaks", ["longest","longest_start","current"])
+Projects = namedtuple("Projects", ["files","added","edited","active","first","last"])
+
+# [(file, day, added, edited)] -> Series
+def load_series(rows):
+	return Series(
+		np.array([r[0] for r in rows], dtype=object),
+		np.array([r[1] for r in rows], dtype='datetime64[D]'),
+		np.array([r[2] for r in rows], dtype=np.int64),
+		np.array([r[3] for r in rows], dtype=np.int64))
+
+def rolling_sum(values, window):
+	acc = np.cumsum(values)
+	acc[window:] = acc[window:] - acc[:-window]
+	return acc
+
+def edit_ratio(added, edited):
+	return np.divide(edited, added, out=np.full(len(added), np.nan), where=added > 0)
+
+# Sums every file into one row per calendar day, including days with no commits
+def daily_totals(s, window=ROLLING_WINDOW):
+	start = s.days.min()
+	idx = (s.days - start).astype(np.int64)
+	n = idx.max() + 1
+	added = np.bincount(idx, weights=s.added, minlength=n).astype(np.int64)
+	edited = np.bincount(idx, weights=s.edited, minlength=n).astype(np.int64)
+	return Daily(start + np.arange(n), added, edited, rolling_sum(added, window), edit_ratio(added, edited))
+
+# Weeks start on Monday; 1970-01-01 was a Thursday
+def weekly_totals(daily):
+	weeks = daily.days - (daily.days.astype(np.int64) + 3) % 7
+	(uweeks, inv) = np.unique(weeks, return_inverse=True)
+	added = np.bincount(inv, weights=daily.added).astype(np.int64)
+	edited = np.bincount(inv, weights=daily.edited).astype(np.int64)
+	return Weekly(uweeks, added, edited)
+
+# A streak is a run of consecutive days with words added. The current streak
+# only counts if it reaches today or yesterday.
+def streaks(daily, today):
+	active = (daily.added > 0).astype(np.int8)
+	edges = np.diff(np.concatenate(([0], active, [0])))
+	starts = np.flatnonzero(edges == 1)
+	ends = np.flatnonzero(edges == -1)
+	if len(starts) == 0:
+		return Streaks(0, None, 0)
+	lengths = ends - starts
+	best = np.argmax(lengths)
+	current = 0
+	if ends[-1] == len(active) and daily.days[-1] >= np.datetime64(today, 'D') - 1:
+		current = int(lengths[-1])
+	return Streaks(int(lengths[best]), daily.days[starts[best]], current)
+
+def project_totals(s):
+	(files, inv) = np.unique(s.files, return_inverse=True)
+	added = np.bincount(inv, weights=s.added).astype(np.int64)
+	edited = np.bincount(inv, weights=s.edited).astype(np.int64)
+	active = np.bincount(inv, weights=s.added > 0).astype(np.int64)
+	dayints = s.days.astype(np.int64)
+	first = np.full(len(files), dayints.max())
+	last = np.full(len(files), dayints.min())
+	np.minimum.at(first, inv, dayints)
+	np.maximum.at(last, inv, dayints)
+	return Projects(files, added, edited, active, first.astype('datetime64[D]'), last.astype('datetime64[D]'))
+
+def compute_stats(rows, today, window=ROLLING_WINDOW):
+	s = load_series(rows)
+	daily = daily_totals(s, window)
+	return (daily, weekly_totals(daily), streaks(daily, today), project_totals(s))
+
+def ratio_str(r):
+	return "" if np.isnan(r) else f"{r:.3f}"
+
+def write_csv(fname, daily):
+	import csv
+	with open(fname, 'w', newline='') as f:
+		w = csv.writer(f)
+		w.writerow(["day", "added", "edited", "rolling", "ratio"])
+		for row in zip(daily.days.astype(str), daily.added, daily.edited, daily.rolling, daily.ratio):
+			w.writerow([row[0], int(row[1]), int(row[2]), int(row[3]), ratio_str(row[4])])
+
+def write_json(fname, stats, window):
+	import json
+	(daily, weekly, streak, projects) = stats
+	out = {
+		"window": window,
+		"daily": [
+			{"day": d, "added": int(a), "edited": int(e), "rolling": int(r), "ratio": None if np.isnan(q) else float(q)}
+			for (d, a, e, r, q) in zip(daily.days.astype(str), daily.added, daily.edited, daily.rolling, daily.ratio)
+		],
+		"weekly": [
+			{"week": w, "added": int(a), "edited": int(e)}
+			for (w, a, e) in zip(weekly.weeks.astype(str), weekly.added, weekly.edited)
+		],
+		"streaks": {
+			"longest": streak.longest,
+			"longest_start": None if streak.longest_start is None else str(streak.longest_start),
+			"current": streak.current
+		},
+		"projects": [
+			{"file": f, "added": int(a), "edited": int(e), "active_days": int(n), "first": str(fd), "last": str(ld)}
+			for (f, a, e, n, fd, ld) in zip(projects.files, projects.added, projects.edited, projects.active, projects.first, projects.last)
+		]
+	}
+	with open(fname, 'w') as f:
+		json.dump(out, f, indent=1)
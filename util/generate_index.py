@@ -0,0 +1,175 @@
+import os
+import sys
+import glob
+import json
+
+from html import escape
+
+# Rebuilds stories-published/index.html from the <name>.meta.json files that
+# parser.py writes with every build and publish.py copies next to each
+# published story. No story HTML is opened. When the stories were built
+# with parser.py --search the page also gets a search box, which fetches
+# only the index shards for the words searched for.
+
+PUBLISH_DIR = f"{os.environ['STORY_ROOT']}/stories-published/"
+INDEX = "index.html"
+
+STYLE = """
+	body {
+		background-color: #201000;
+		color: #CCAA77;
+		font-family: 'Arial', sans-serif;
+		margin: 2em;
+	}
+	a {
+		color: #77BBBB;
+	}
+	a:visited {
+		color: #7766BB;
+	}
+	td {
+		padding: 0.2em 1em 0.2em 0;
+	}
+"""
+
+# Must split words and pick shards the way parser.py's search index does
+SEARCH_SCRIPT = """
+const WORD = /[\\p{L}\\p{N}_]+(?:'[\\p{L}\\p{N}_]+)*/gu;
+const PREFIX = 2;
+const MAX_LINKS = 20;
+const shards = {};
+let stories = null;
+
+function load(shard) {
+	if (!(shard in shards))
+		shards[shard] = fetch("search/" + shard + ".json").then(r => r.ok ? r.json() : {});
+	return shards[shard];
+}
+
+// Paragraphs that have every word, per story
+async function find(query) {
+	const words = [...new Set(query.toLowerCase().match(WORD) || [])];
+	const postings = await Promise.all(words.map(w => load(w.slice(0, PREFIX)).then(s => s[w] || {})));
+	const hits = [];
+	if (!postings.length)
+		return hits;
+	for (const [name, lines] of Object.entries(postings[0])) {
+		let common = lines;
+		for (const p of postings.slice(1)) {
+			const other = new Set(p[name] || []);
+			common = common.filter(l => other.has(l));
+		}
+		if (common.length)
+			hits.push([name, common]);
+	}
+	return hits;
+}
+
+// Paginated stories list the line each chapter page starts on
+function lineHref(story, name, line) {
+	const pages = story.pages || [];
+	if (!pages.length)
+		return name + ".html#L" + line;
+	let page = pages[0][1];
+	for (const [first, file] of pages)
+		if (first <= line)
+			page = file;
+	return name + ".pages/" + page + "#L" + line;
+}
+
+async function search(event) {
+	event.preventDefault();
+	stories = stories || fetch("search/stories.json").then(r => r.json());
+	const hits = await find(document.getElementById("query").value);
+	const titles = await stories;
+	const results = document.getElementById("results");
+	results.replaceChildren();
+	for (const [name, lines] of hits.sort((a, b) => b[1].length - a[1].length)) {
+		const p = document.createElement("p");
+		const a = document.createElement("a");
+		a.href = name + ".html";
+		a.textContent = (titles[name] || {}).title || name;
+		p.append(a, ` (${lines.length}): `);
+		for (const line of lines.slice(0, MAX_LINKS)) {
+			const link = document.createElement("a");
+			link.href = lineHref(titles[name] || {}, name, line);
+			link.textContent = "\u00b6";
+			p.append(link, " ");
+		}
+		results.append(p);
+	}
+	if (!hits.length)
+		results.textContent = "Nothing found";
+}
+"""
+
+SEARCH_FORM = """
+		<form onsubmit="search(event)">
+			<input id="query" type="search" placeholder="Search the stories">
+		</form>
+		<div id="results"></div>
+"""
+
+def read_metadata(pubdir):
+	stories = []
+	for fname in glob.glob(os.path.join(pubdir, "*.meta.json")):
+		try:
+			with open(fname) as f:
+				stories.append(json.load(f))
+		except ValueError:
+			print(f"WARNING: ignoring unreadable {fname}")
+	return stories
+
+# Newest first; dates are free text in the prelude, so undated stories go
+# last and the rest sort as written
+def sort_key(meta):
+	return (meta.get("date") is not None, str(meta.get("date") or ""), str(meta.get("title") or ""))
+
+def render_row(meta):
+	title = escape(str(meta.get("title") or meta["name"]))
+	cells = [f'<a href="{escape(meta["name"])}.html">{title}</a>',
+		escape(str(meta.get("author") or "")),
+		escape(str(meta.get("date") or "")),
+		f'{meta.get("words", 0):,} words',
+		escape(str(meta.get("status") or ""))]
+	return "\t\t\t<tr>" + "".join(f"<td>{c}</td>" for c in cells) + "</tr>\n"
+
+def render_index(stories, searchable=False):
+	rows = "".join(render_row(m) for m in sorted(stories, key=sort_key, reverse=True))
+	script = f"<script>{SEARCH_SCRIPT}</script>" if searchable else ""
+	form = SEARCH_FORM if searchable else ""
+	return f"""<html>
+	<head>
+		<meta charset="UTF-8">
+		<style>
+		{STYLE}
+		</style>
+		{script}
+	</head>
+	<body>
+		<h1>Stories</h1>
+		{form}
+		<table>
+{rows}		</table>
+	</body>
+</html>
+"""
+
+def main():
+	pubdir = sys.argv[1] if len(sys.argv) > 1 else PUBLISH_DIR
+	stories = read_metadata(pubdir)
+	index = render_index(stories, os.path.exists(os.path.join(pubdir, "search", "stories.json")))
+	fname = os.path.join(pubdir, INDEX)
+	if os.path.exists(fname):
+		with open(fname) as f:
+			if f.read() == index:
+				print(f"Index of {len(stories)} stories unchanged")
+				return
+	tmpname = "%s.%d.tmp" % (fname, os.getpid())
+	with open(tmpname, 'w') as f:
+		f.write(index)
+	os.replace(tmpname, fname)
+	print(f"Wrote index of {len(stories)} stories")
+
+if __name__ == '__main__':
+	main()
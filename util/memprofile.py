@@ -0,0 +1,122 @@
+import json
+import tracemalloc
+
+from contextlib import contextmanager
+
+# tracemalloc memory report for parser.py and count.py (--memprofile). Every
+# phase records the peak traced memory while it ran and what it left
+# allocated when it finished. Retained memory of a nested phase is taken off
+# the outer one, like the phase timings. After each outermost phase the
+# allocations are totalled per source line and compared with the previous
+# totals to find the lines that grew. Only the totals are kept, since a whole
+# snapshot would count towards the next phase's peak.
+
+TOP_SITES = 10
+# growth smaller than this isn't worth listing
+MIN_SITE = 1024
+IGNORED = [tracemalloc.__file__, __file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>"]
+
+class MemoryProfile:
+	def __init__(self, frames=1):
+		self.peaks = dict()
+		self.retained = dict()
+		self.sites = dict()
+		self.stack = []
+		self.live = []
+		self.peak = 0
+		self.started = not tracemalloc.is_tracing()
+		if self.started:
+			tracemalloc.start(frames)
+		self.last = line_totals()
+
+	@contextmanager
+	def phase(self, name):
+		(before, peak) = tracemalloc.get_traced_memory()
+		if self.stack:
+			self.stack[-1][1] = max(self.stack[-1][1], peak)
+		tracemalloc.reset_peak()
+		self.stack.append([name, 0])
+		try:
+			yield
+		finally:
+			(after, peak) = tracemalloc.get_traced_memory()
+			peak = max(peak, self.stack.pop()[1])
+			self.peaks[name] = max(self.peaks.get(name, 0), peak)
+			self.retained[name] = self.retained.get(name, 0) + after - before
+			self.peak = max(self.peak, peak)
+			if self.stack:
+				outer = self.stack[-1]
+				outer[1] = max(outer[1], peak)
+				self.retained[outer[0]] = self.retained.get(outer[0], 0) - (after - before)
+			else:
+				self.compare(name)
+
+	# Adds up the growth per source line since the last totals
+	def compare(self, name):
+		(prev, self.last) = (self.last, line_totals())
+		sites = self.sites.setdefault(name, dict())
+		for (where, (size, count)) in self.last.items():
+			(psize, pcount) = prev.get(where, (0, 0))
+			if size != psize:
+				(ssize, scount) = sites.get(where, (0, 0))
+				sites[where] = (ssize + size - psize, scount + count - pcount)
+
+	# Records what is still allocated and stops tracing if we started it
+	def stop(self):
+		self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+		live = line_totals()
+		self.live = sorted(((where, size, count) for (where, (size, count)) in live.items()), key=lambda r: -r[1])[:TOP_SITES]
+		if self.started:
+			tracemalloc.stop()
+
+	# [(String, Int, Int)] for one phase, biggest growth first
+	def top_sites(self, name):
+		sites = self.sites.get(name, {})
+		rows = [(where, size, count) for (where, (size, count)) in sites.items() if size >= MIN_SITE]
+		return sorted(rows, key=lambda r: -r[1])[:TOP_SITES]
+
+	def report(self, title):
+		print(f"Memory for {title} (peak {mb(self.peak)}):")
+		print(f"  {'phase':<12} {'peak':>10} {'retained':>10}")
+		for name in self.peaks:
+			print(f"  {name:<12} {mb(self.peaks[name]):>10} {mb(self.retained[name], True):>10}")
+		for name in self.peaks:
+			rows = self.top_sites(name)
+			if rows:
+				print(f"  grew during {name}:")
+				for (where, size, count) in rows:
+					print(f"    {mb(size, True):>10} {count:>8} blocks  {where}")
+		if self.live:
+			print("  still allocated at the end:")
+			for (where, size, count) in self.live:
+				print(f"    {mb(size):>10} {count:>8} blocks  {where}")
+
+	def write(self, fname, **info):
+		data = dict(info)
+		data["peak"] = self.peak
+		data["phases"] = dict((name, {"peak": self.peaks[name], "retained": self.retained[name],
+			"sites": [{"where": w, "size": s, "count": c} for (w, s, c) in self.top_sites(name)]})
+			for name in self.peaks)
+		data["live"] = [{"where": w, "size": s, "count": c} for (w, s, c) in self.live]
+		with open(fname, 'w') as f:
+			json.dump(data, f, indent=1)
+			f.write("\n")
+
+# {"file:line": (size, count)} for everything traced right now, leaving out
+# the profiler itself. Resets the peak so taking it doesn't show up in the
+# next phase.
+def line_totals():
+	snap = tracemalloc.take_snapshot()
+	totals = dict()
+	for stat in snap.statistics('lineno'):
+		frame = stat.traceback[0]
+		if frame.filename not in IGNORED:
+			totals[str(frame)] = (stat.size, stat.count)
+	del snap
+	tracemalloc.reset_peak()
+	return totals
+
+def mb(n, signed=False):
+	if abs(n) < 1024 * 1024:
+		return ("%+.1fKB" if signed else "%.1fKB") % (n / 1024)
+	return ("%+.2fMB" if signed else "%.2fMB") % (n / (1024 * 1024))
@@ -7,23 +7,34 @@ import subprocess
 import xml.etree.ElementTree as xml
 import uuid as UUID
 import zipfile 
+import pickle
+import hashlib
+import threading
+import gzip
+import time
+import json
 
 from string import Template
+from contextlib import contextmanager, nullcontext
 
 from collections import defaultdict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
 
 #==================
 # Global functions
 #==================
 
-USE_LETTRINE = False
-ALT_STYLE = False
-SKIP_TESTS = False
-PRINT_NUMBERING = False
 DEBUG = True
-ALL_CHS = dict()
-IS_TESTING = False
 EPUB_SRCDIR = "epub-src/"
+INCLUDE_CACHE = dict()
+TESTED = False
+TEST_LOCK = threading.Lock()
 
 def setg(s,val):
 	globals()[s] = val;
@@ -59,13 +70,129 @@ def writefile(fname, s):
 	with open(fname, 'w') as f:
 		f.write(s)
 
-def reset_globals():
-	setg('USE_LETTRINE', 0)
-	setg('PRINT_NUMBERING', 0)
-	setg('ALT_STYLE', 0)
-	setg('SKIP_TESTS', 0)
-	setg('ALL_CHS', {})
-	setg('IS_TESTING', False)
+# Leaves fname untouched when it already holds s, so its mtime and
+# compressed copies stay valid. Returns whether it wrote.
+def write_if_changed(fname, s):
+	if os.path.exists(fname) and readfile(fname) == s:
+		return False
+	writefile(fname, s)
+	return True
+
+def writebytes_atomic(fname, data):
+	tmpname = "%s.%d.%d.tmp" % (fname, os.getpid(), threading.get_ident())
+	with open(tmpname, 'wb') as f:
+		f.write(data)
+	os.replace(tmpname, fname)
+
+def is_newer(fname, than):
+	return os.path.exists(fname) and os.path.getmtime(fname) >= os.path.getmtime(than)
+
+# Writes fname.gz, and fname.br when brotli is installed, next to fname at
+# maximum compression so a static server can send them as they are. A
+# variant newer than fname is still up to date and kept. gzip gets no
+# timestamp, so the same content always gives the same bytes.
+def write_compressed(fname, s):
+	variants = [(".gz", lambda d: gzip.compress(d, 9, mtime=0))]
+	if brotli:
+		variants.append((".br", lambda d: brotli.compress(d, quality=11)))
+	elif os.path.exists(fname + ".br") and not is_newer(fname + ".br", fname):
+		# left over from when brotli was around
+		os.remove(fname + ".br")
+	data = None
+	for (ext, compress) in variants:
+		if not is_newer(fname + ext, fname):
+			data = data or s.encode('utf-8')
+			writebytes_atomic(fname + ext, compress(data))
+
+# Everything one build of one book needs to carry between parsing and
+# rendering. Nothing per-book lives in module globals, so several books can be
+# built at once in the same process.
+class BuildContext:
+	def __init__(self, include_cache_dir=None):
+		self.use_lettrine = False
+		self.alt_style = False
+		self.print_numbering = False
+		self.skip_tests = False
+		self.all_chs = dict()
+		self.include_cache_dir = include_cache_dir
+		# the files whose %include led to this book, outermost first
+		self.including = ()
+		self.timer = None
+		self.chapter_stats = None
+
+# Command line switches that change what a build writes or reports
+class BuildOptions:
+	def __init__(self, timings=False, chapter_stats=False, memprofile=False, compress=False, author=None, search=False,
+			paginate=False, prefetch=False):
+		self.timings = timings
+		self.chapter_stats = chapter_stats
+		self.memprofile = memprofile
+		self.compress = compress
+		self.author = author
+		self.search = search
+		self.paginate = paginate
+		self.prefetch = prefetch
+
+# Wall clock per build phase (--timings). Time spent in a phase nested inside
+# another is taken off the outer one, so the phases add up to the build.
+# With a memprofile.MemoryProfile (--memprofile) every phase is also tracked
+# by tracemalloc.
+class PhaseTimer:
+	def __init__(self, memory=None):
+		self.times = dict()
+		self.stack = []
+		self.memory = memory
+
+	@contextmanager
+	def phase(self, name):
+		self.stack.append(name)
+		start = time.perf_counter()
+		try:
+			with self.memory.phase(name) if self.memory else nullcontext():
+				yield
+		finally:
+			secs = time.perf_counter() - start
+			self.stack.pop()
+			self.times[name] = self.times.get(name, 0.0) + secs
+			if self.stack:
+				outer = self.stack[-1]
+				self.times[outer] = self.times.get(outer, 0.0) - secs
+
+	# Counts the time spent producing each item towards name
+	def iterate(self, name, it):
+		it = iter(it)
+		while True:
+			with self.phase(name):
+				item = next(it, StopIteration)
+			if item is StopIteration:
+				return
+			yield item
+
+# Does nothing unless the build is being timed
+def phase(ctx, name):
+	if ctx is None or ctx.timer is None:
+		return nullcontext()
+	return ctx.timer.phase(name)
+
+def timed(ctx, name, it):
+	if ctx is None or ctx.timer is None:
+		return it
+	return ctx.timer.iterate(name, it)
+
+# Per chapter parse and render cost (--chapter-stats), keyed by chapter number
+# Measurements are keyed by the Chapter itself, since chapters titled
+# without a number all have num None
+class ChapterStats:
+	def __init__(self, outformat):
+		self.outformat = outformat
+		self.parsed = dict()
+		self.rendered = dict()
+
+	def parse(self, ch, lines, secs):
+		self.parsed[ch] = (lines, secs)
+
+	def render(self, ch, secs, rendered):
+		self.rendered[ch] = (secs, len(rendered.encode('utf-8')))
 
 def debug(s):
 	if DEBUG:
@@ -171,6 +298,12 @@ class Node(MyObj):
 		self.tag = tag
 		self.content = content
 		self.other = other
+		# Merging only ever joins siblings of the same tag, which leaves the
+		# depth alone, so it is worked out once here
+		if isinstance(content, list):
+			self.nesting = 1 + max((c.nesting for c in content), default=0)
+		else:
+			self.nesting = 1
 
 	def __str__(self):
 		s = self.tag
@@ -222,10 +355,7 @@ class Node(MyObj):
 		return (self.lineno, self.chlineno, self.chunkstart)
 
 	def depth(self):
-		if self.tag in ('REGULAR', 'TODO', 'PRAGMA', 'BEAT_SEP'):
-			return 1
-		else:
-			return 1 + max(map(lambda x: x.depth(), self.content))
+		return self.nesting
 
 	def merge(self, other):
 		if self.tag == 'REGULAR':
@@ -252,9 +382,12 @@ class Chapter:
 		return "Chapter %s\n%s (%s)\n%s" % (self.num, self.label, self.desc, str(self.chunks))
 
 class Book:
-	def __init__(self, prelude, chs):
+	def __init__(self, prelude, chs, deps=None, includes=None, ctx=None):
 		self.prelude = prelude
 		self.chs = chs
+		self.deps = deps or {}
+		self.includes = includes or {}
+		self.ctx = ctx or BuildContext()
 	def __str__(self):
 
 		return str(self.prelude) + "\n" + "\n".join(map(str, self.chs))
@@ -269,45 +402,53 @@ def merge_node(a,b):
 	else:
 		return (a, False)
 
+# Merges runs of same-tagged neighbours in place. A lone node has its content
+# merged; otherwise only the content of nodes that were merged is. Nested
+# lists are handled on an explicit stack of [list, index] frames, each run to
+# completion before its parent carries on.
 def merge_do(lst, f):
 	if lst is None:
 		error('(merge_do)')
-	i = 0
-	if len(lst) == 0:
-		return lst
-	elif len(lst) == 1:
-		first = lst[0]
-		if first.depth() > 1:
-			first.content = merge_do(first.content, merge_node)
-		return [first]
-	while True:
-		cur = lst.pop(i)
-		if i < len(lst):
-			next = lst.pop(i)
-			(res, change) = f(cur,next)
-			lst.insert(i, res)
-			if not change:
-				lst.insert(i+1, next)
-				i += 1
-			elif res.tag != 'REGULAR':
-				res.content = merge_do(res.content, merge_node)
+	stack = []
+	merge_enter(stack, lst)
+	while stack:
+		frame = stack[-1]
+		(cur, i) = frame
+		if i + 1 >= len(cur):
+			stack.pop()
+			continue
+		(res, change) = f(cur[i], cur[i+1])
+		if not change:
+			frame[1] = i + 1
 		else:
-			lst.insert(i, cur)
-			break
+			cur[i:i+2] = [res]
+			if res.tag != 'REGULAR':
+				merge_enter(stack, res.content)
 	return lst
 
+def merge_enter(stack, lst):
+	while len(lst) == 1 and lst[0].depth() > 1:
+		lst = lst[0].content
+	if len(lst) > 1:
+		stack.append([lst, 0])
+
 
 # [Text] -> [Text]
 def merge_chunks(acc):
 	return merge_do(acc, merge_node)
 
+BLOCK_COMMENT = re.compile("/\\*[^*]*\\*/")
+LINE_COMMENT = re.compile("(\\s+)?#.*")
+
 # String -> String
 def rm_comment(line):
-	line = re.sub("\r", "", line)
+	line = line.replace("\r", "")
 	if len(line) > 2 and line[:2] == '##':
 		return line
-	line = re.sub("/\*[^*]*\*/", "", line)
-	line = re.sub("(\s+)?#.*", "", line)
+	if '/*' in line:
+		line = BLOCK_COMMENT.sub("", line)
+	if '#' in line:
+		line = LINE_COMMENT.sub("", line)
 	return line
 
 def isempty(line):
@@ -318,8 +459,8 @@ def starts(line, c):
 		error('(starts)')
 	return len(line) > 0 and line[0] == c
 
-# [String] -> (Prelude, [String])
-def parse_prelude(lines):
+# ([String], BuildContext) -> (Prelude, [String])
+def parse_prelude(lines, ctx):
 	orig = list(lines)
 	title = None
 	author = None
@@ -332,13 +473,13 @@ def parse_prelude(lines):
 		if line_text[0] == '%':
 			spragma = line_text[1:]
 			if spragma == 'lettrine':
-				setg('USE_LETTRINE', 1)
+				ctx.use_lettrine = True
 			elif spragma == 'altstyle':
-				setg('ALT_STYLE', 1)
+				ctx.alt_style = True
 			elif spragma == 'printnum':
-				setg('PRINT_NUMBERING', 1)
+				ctx.print_numbering = True
 			elif spragma == 'skiptests':
-				setg('SKIP_TESTS', 1)
+				ctx.skip_tests = True
 			else:
 				error("Unexpected global pragma '%s'" % spragma)
 		if ':Title:' in line_text:
@@ -456,36 +597,47 @@ def allowed_tags(lvl, cur):
 	else:
 		return list(set(open_tags) - set(cur) - set(['/','|']))
 
-# String -> ([Text],Bool,Bool)
-def parse_text(line, linenum, ch_linenum, charnum, i=0, lvl=0, cur=[]):
-	#debug("PARSE TEXT %s" % str((line, i, cur)))
-	chunks = []
-	foundEnd = False
-	foundTrans = False
-	if line != str(line):
-		error('(parse_text) %s' % line)
+# Whole-line forms: todo markers, pragmas and separators. These are checked
+# for every nested span as well as the line itself.
+# (String, Int, Int, Int) -> ([Text],Bool)
+def parse_line_form(line, linenum, ch_linenum, i):
 	if line == '---':
-		return ([Node('TODO').pos((linenum,ch_linenum,i))], False, False)
+		return ([Node('TODO').pos((linenum,ch_linenum,i))], False)
 	elif len(line) and line[0] == '%':
-		line = line#.strip()
 		line = line[1:]
 		if ' ' in line:
 			(left,right) = line.split(' ', 1)
 		else:
 			(left,right) = (line, None)
-		istransclude = left == 'transclude'
-		return ([Node('PRAGMA', left, right).pos((linenum,ch_linenum,i))], False, istransclude)
+		istransclude = left in ('transclude', 'include')
+		return ([Node('PRAGMA', left, right).pos((linenum,ch_linenum,i))], istransclude)
 	elif len(line) > 1 and line[0:2] == '//':
 		if line[2] == '!':
 			error("Bad ch split tag: '%s'" % line)
 		elif line[2] in ('-', '&'):
-			return ([Node('BEAT_SEP').pos((linenum,ch_linenum,i))], False, False)
+			return ([Node('BEAT_SEP').pos((linenum,ch_linenum,i))], False)
 		else:
 			error("Unknown separator '%s'" % line)
 
+# A stretch of a line being parsed at one nesting level
+class TextSpan:
+	def __init__(self, line, charnum, i, lvl, cur):
+		self.line = line
+		self.charnum = charnum
+		self.i = i
+		self.lvl = lvl
+		self.cur = cur
+		self.chunks = []
+
+# Scans a span up to its next nested tag. Returns the nested span and a
+# function that wraps the chunks parsed from it into a node of this span, or
+# None once the span is finished.
+# (TextSpan, Int, Int) -> (TextSpan, [Text] -> ())
+def scan_span(span, linenum, ch_linenum):
+	line = span.line
+	(charnum, i, lvl, cur) = (span.charnum, span.i, span.lvl, span.cur)
 	while i < len(line):
 		c = line[i]
-		#print("C IS: " + c)
 		if c == '`' and i < len(line)  - 1 and line[i+1] == '`':
 			i += 1
 			c = '``'
@@ -500,46 +652,69 @@ def parse_text(line, linenum, ch_linenum, charnum, i=0, lvl=0, cur=[]):
 		if not slash_exception and (c in open_tags and c not in allowed_tags(lvl,cur)):
 			error("tag '%s' not allowed here: %s, %d" % (c, line, linenum))
 		elif c == '>' and lvl == 0:
-			#print('dash')
 			typ = 0
 			i += 1
 			if i < len(line) and line[i] == '>':
 				i += 1
 				typ = 1
 			(_, bi) = eat(line, [], [], i)
-			(parsed, end, _) = parse_text(line, linenum, ch_linenum, charnum+i, i, lvl+1, cur+['/'])
-			made = Node('DASHQUOTE', parsed, typ).pos((linenum, ch_linenum, charnum))
-			#print("APPEND" + str(made))
-			i = bi
-			chunks.append(made)
+			span.i = bi
+			pos = (linenum, ch_linenum, charnum)
+			def finish(parsed):
+				span.chunks.append(Node('DASHQUOTE', parsed, typ).pos(pos))
+			return (TextSpan(line, charnum+i, i, lvl+1, cur+['/']), finish)
 
 		elif c in open_tags:
-			#print("open")
 			end = get_close(c)
 			ctor = get_ctor(c)
 			(eaten, i) = eat(line, [end], [], i+1)
-			(parsed, end, _) = parse_text(eaten, linenum, ch_linenum, charnum+i, 0, lvl+1, cur+[c])
-			#debug("PARSED: %s" % parsed)
-			made = ctor(parsed).pos((linenum, ch_linenum, charnum))
+			nested = TextSpan(eaten, charnum+i, 0, lvl+1, cur+[c])
+			pos = (linenum, ch_linenum, charnum)
+			other = None
 			if c in ('|','/') and i <= len(line) - 2 and line[i+1] == '>':
-				made.other = line[i:i+2]
+				other = line[i:i+2]
 				i += 2
-			chunks.append(made)
-			if end:
-				foundEnd = True
-				break
+			span.i = i
+			def finish(parsed):
+				made = ctor(parsed).pos(pos)
+				if other is not None:
+					made.other = other
+				span.chunks.append(made)
+			return (nested, finish)
 		else:
-			#print("regular")
 			bi = i
 			(eaten,i) = eat(line, [], open_tags, i)
-			#debug("REDULAR(%s) %d -> %d" % (eaten, bi, i))
-			#if i < len(line):
-			#	debug("NEXTCHAR(%s)" % (repr(line[i])))
 			made = REGULAR(eaten).pos((linenum,ch_linenum,charnum+bi))
-			#print("REG" + str(made))
-			chunks.append(made)
+			span.chunks.append(made)
+	span.i = i
+	return None
 
-	return (chunks, foundEnd, False)
+# Nested tags are parsed on an explicit stack of spans rather than by
+# recursion, so deep nesting costs no python stack.
+# String -> ([Text],Bool,Bool)
+def parse_text(line, linenum, ch_linenum, charnum, i=0, lvl=0, cur=[]):
+	if line != str(line):
+		error('(parse_text) %s' % line)
+	form = parse_line_form(line, linenum, ch_linenum, i)
+	if form:
+		return (form[0], False, form[1])
+
+	stack = [(TextSpan(line, charnum, i, lvl, cur), None)]
+	while True:
+		(span, finish) = stack[-1]
+		nested = scan_span(span, linenum, ch_linenum)
+		if nested:
+			(sub, subfinish) = nested
+			form = parse_line_form(sub.line, linenum, ch_linenum, sub.i)
+			if form:
+				subfinish(form[0])
+			else:
+				stack.append(nested)
+			continue
+		stack.pop()
+		if not stack:
+			return (span.chunks, False, False)
+		finish(span.chunks)
 
 def is_ch_sep(line):
 	if line != str(line):
@@ -547,8 +722,6 @@ def is_ch_sep(line):
 	return re.match("//!*//", line)
 
 def run_tests():
-	global IS_TESTING
-	IS_TESTING = True
 	merge_tests = [
 		[
 			[
@@ -864,6 +1037,21 @@ Paragraph 2
 	if render_test(parsed).count("''") != 1:
 		error("dialog should be continued")
 
+	transdoc = """
+//!!!//
+##A (first)
+
+%transclude B
+
+//!!!//
+##B (second)
+
+transcluded text
+"""
+
+	if render_test(parse(transdoc.split("\n"))).count("transcluded text") != 2:
+		error("forward transclusion failed")
+
 	parsed = parse(commentdoc.split("\n"))
 	chunks = parsed.chs[0].chunks[0]
 	if chunks[0] == []:
@@ -1070,22 +1258,28 @@ Cras sed cursus leo, nec consectetur eni.
 			error("Parse fail in test doc")
 		i += 1
 	setg("DEBUG", old_debug)
-	reset_globals()
+
+# Self tests only need to pass once per process however many books it builds
+def run_tests_once():
+	global TESTED
+	with TEST_LOCK:
+		if not TESTED:
+			run_tests()
+			TESTED = True
 
 # =====================
 ## Parser
 # ====================
 
 # [String] -> ([Para], [String], Bool, Bool)
-def parse_paras(lines):
+def parse_paras(lines, ctx=None):
 	linect = 0
-	beforeChunks = []
 	chunks = []
 	isend = False
 	islast = False
 	isskip = False
 	chline = 0
-	foundtrans = False
+	parts = []
 	while lines:
 		noline = lines.pop(0)
 		line_num = noline[0]
@@ -1116,50 +1310,107 @@ def parse_paras(lines):
 			else:
 				(text, islast, trans) = parse_text(line_text, line_num, chline, 0)
 				if trans:
-					foundtrans = 1
-					beforeChunks = chunks
+					parts.append((False, chunks))
+					parts.append((True, text))
 					chunks = []
-				chunks.append(text)
+				else:
+					chunks.append(text)
 				lines.pop(0)
 			if islast:
 				break
 		chline += 1
-	found = 0
-	transCh = None
-	if foundtrans:
-		i = 0
-		for c in chunks:
-			if len(c) == 1:
-				c = c[0]
-				if c.tag == 'PRAGMA':
-					found = 1
-					transCh = c.other
-					chunks.pop(0)
-					break
-			i += 1
-		if not found:
-			error('not found')
-	if transCh:
-		bgrouped = group_paras(beforeChunks)
-		res = []
-		for c in bgrouped:
-			res.append(merge_chunks(c))
-		for c in ALL_CHS[transCh]:
-			for k in c:
-				res.append(k)
-		grouped = group_paras(chunks)
-		for c in grouped:
-			res.append(merge_chunks(c))
-		return (res, lines, isend, islast, isskip)
-	else:
-		grouped = group_paras(chunks)
-		res = []
-		for c in grouped:
-			res.append(merge_chunks(c))
-		return (res, lines, isend, islast, isskip)
+	# transclusions stay in the paragraph list as their own [PRAGMA]
+	# paragraph and are expanded by the Renderer
+	parts.append((False, chunks))
+	res = []
+	with phase(ctx, "merge"):
+		for (istrans, part) in parts:
+			if istrans:
+				res.append(part)
+				continue
+			for c in group_paras(part):
+				res.append(merge_chunks(c))
+	return (res, lines, isend, islast, isskip)
 
 flatten = lambda l: [item for sublist in l for item in sublist]
 
+# Para -> ChNum
+def transclusion_of(para):
+	if len(para) == 1 and para[0].tag == 'PRAGMA' and para[0].content == 'transclude':
+		return para[0].other
+
+# Para -> String
+def include_of(para):
+	if len(para) == 1 and para[0].tag == 'PRAGMA' and para[0].content == 'include':
+		return para[0].other
+
+# A paragraph spliced in by %include. Its nodes keep the line numbers of the
+# file they came from, so in the book it is found at the %include line, which
+# only the first of the included paragraphs is anchored to.
+class IncludedPara(list):
+	def __init__(self, para, lineno, first):
+		super().__init__(para)
+		self.lineno = lineno
+		self.first = first
+
+# The book line a paragraph is found at
+# Para -> Int
+def para_lineno(para):
+	return para.lineno if isinstance(para, IncludedPara) else para[0].lineno
+
+def para_anchored(para):
+	return bool(para) and (not isinstance(para, IncludedPara) or para.first)
+
+# [Para] -> [Para]
+def expand_transclusions(paras, chmap):
+	res = []
+	for p in paras:
+		trans = transclusion_of(p)
+		if trans is None:
+			res.append(p)
+		else:
+			res.extend(expand_transclusions(flatten(chmap[trans]), chmap))
+	return res
+
+# [Chunk] -> [ChNum]
+def node_transclusions(nodes):
+	found = []
+	stack = list(reversed(nodes))
+	while stack:
+		n = stack.pop()
+		if n.tag == 'PRAGMA':
+			if n.content == 'transclude':
+				found.append(n.other)
+		elif isinstance(n.content, list):
+			stack.extend(reversed(n.content))
+	return found
+
+# Builds the chapter -> transcluded chapters graph once every chapter has been
+# parsed, so a chapter may transclude one that comes after it. Missing targets
+# and cycles are errors.
+# {ChNum: [[Para]]} -> {ChNum: [ChNum]}
+def resolve_transclusions(chs):
+	graph = {}
+	for (num, allpara) in chs.items():
+		graph[num] = node_transclusions(flatten(flatten(allpara)))
+		for dep in graph[num]:
+			if dep not in chs:
+				error("Cannot transclude chapter %s, not found" % dep)
+	state = {}
+	def visit(num, path):
+		state[num] = 1
+		for dep in graph[num]:
+			if state.get(dep) == 1:
+				cycle = path[path.index(dep):] + [dep]
+				error("Transclusion cycle: %s" % " -> ".join(map(str, cycle)))
+			elif dep not in state:
+				visit(dep, path + [dep])
+		state[num] = 2
+	for num in graph:
+		if num not in state:
+			visit(num, [num])
+	return graph
+
 def group_paras(paras):
 	prev = None
 	allchunks = []
@@ -1200,12 +1451,11 @@ def search_for_title(lines):
 
 
 
-# ([String],ChNum) -> (Chapter, [String], Bool)
-def parse_ch(lines,chnum):
+# ([String],BuildContext) -> (Chapter, [String], Bool)
+def parse_ch(lines,ctx):
 	title = None
 	islast = False
 	gotsep = False
-	ignoresep = False
 	allpara = []
 	while lines:
 		if not title and not search_for_title(lines):
@@ -1218,28 +1468,22 @@ def parse_ch(lines,chnum):
 				if not starts(line_text, '/'):
 					raise Exception("Expected chsep, got: '"+line_text+"'")
 				else:
-					ignoresep = False
 					gotsep = True
 			elif isempty(line_text):
 				continue
 			elif not starts(line_text, '#'):
-				if not ignoresep:
-					expected("chapter title (parse_ch)", line_text, True)
+				expected("chapter title (parse_ch)", line_text, True)
 				continue
 			else:
 				title = parse_title(line_text)
 		else:
-			if chnum and title and len(title) == 3 and title[0] != chnum:
-				title = None
-				ignoresep = True
-				continue
 			lines.insert(0, noline)
 			while lines:
 				noline = lines.pop(0)
 				if not isempty(noline[1]):
 					lines.insert(0, noline)
 					break
-			(paras, lines, isend, islast, isskip) = parse_paras(lines)
+			(paras, lines, isend, islast, isskip) = parse_paras(lines, ctx)
 			allpara.append(paras)
 			if islast or isend or isskip:
 				break
@@ -1250,29 +1494,44 @@ def parse_ch(lines,chnum):
 	if not title or not title[1]:
 		return (None, lines, True)
 	debug("Parsed chapter %s" % str(title[1]))
-	ALL_CHS[title[0]] = allpara
+	ctx.all_chs[title[0]] = allpara
 	return (Chapter(title, allpara), lines, islast)
 
 
-# ([String],ChNum) -> ([Chapter], [String])
-def parse_chs(lines, chnum):
+# Counts the source lines a chapter took up, up to the next one or the end
+def parse_ch_measured(lines, ctx):
+	(first, last) = (lines[0][0], lines[-1][0])
+	start = time.perf_counter()
+	chapter = parse_ch(lines, ctx)
+	secs = time.perf_counter() - start
+	if chapter and chapter[0]:
+		rest = chapter[1]
+		ctx.chapter_stats.parse(chapter[0], (rest[0][0] if rest else last + 1) - first, secs)
+	return chapter
+
+# Takes the chapter chunks from split_chapters one at a time, so only the
+# chapter being parsed is held in memory.
+# (Iterable [[String]],BuildContext) -> [Chapter]
+def parse_chs(chunks, ctx):
 	chs = []
-	end = False
-	while lines:
-		noline = lines.pop(0)
-		line_text = noline[1]
-		if isempty(line_text):
-			continue
-		lines.insert(0, noline)
-		chapter = parse_ch(lines, chnum)
-		if chapter:
-			(ch, lines, end) = chapter
-			if ch:
-				chs.append(ch)
-			if end:
-				break
-
-	return (chs, lines)
+	for lines in chunks:
+		while lines:
+			noline = lines.pop(0)
+			line_text = noline[1]
+			if isempty(line_text):
+				continue
+			lines.insert(0, noline)
+			if ctx.chapter_stats is None:
+				chapter = parse_ch(lines, ctx)
+			else:
+				chapter = parse_ch_measured(lines, ctx)
+			if chapter:
+				(ch, lines, end) = chapter
+				if ch:
+					chs.append(ch)
+				if end:
+					return chs
+	return chs
 
 def is_full_comment(line):
 	if line != str(line):
@@ -1282,41 +1541,269 @@ def is_full_comment(line):
 	else:
 		return len(line) >= 1 and line[0] == '#'
 
+#=============
+# Front end
+#=============
+
+# The input goes through a chain of generators, numbered lines -> comments
+# stripped -> blank runs collapsed -> chapter chunks, and is consumed one
+# chapter at a time.
+
+# Iterable [String] -> Iterable [String]
+def strip_comments(numlines):
+	for (lineno, line_text) in numlines:
+		yield (lineno, rm_comment(line_text))
+
+# Keeps only the last blank line of a run, and only if text follows it
+# Iterable [String] -> Iterable [String]
+def collapse_blanks(numlines):
+	lastblank = None
+	for noline in numlines:
+		if isempty(noline[1]):
+			lastblank = noline
+			continue
+		if lastblank:
+			yield lastblank
+			lastblank = None
+		yield noline
+
 # [String] -> [String]
 def remove_comments(lines):
-	res = []
-	lastcomment = False
-	for noline in lines:
-		lineno = noline[0]
-		line_text = noline[1]
-		line_text = rm_comment(line_text)
-		res.append((lineno, line_text))
-
-	res2 = []
-	for noline in res:
-		lineno = noline[0]
+	return list(collapse_blanks(strip_comments(lines)))
+
+# The first chunk is everything before the first line starting with '/', for
+# parse_prelude. After that a chapter separator starts a new chunk, but only
+# once the current chunk has a title, as parse_ch reads past untitled
+# separators looking for one.
+# Iterable [String] -> Iterable [[String]]
+def split_chapters(numlines):
+	chunk = []
+	inprelude = True
+	titled = False
+	for noline in numlines:
 		line_text = noline[1]
-		if isempty(line_text):
-			lastcomment = noline
-			continue
-		else:
-			if lastcomment:
-				res2.append(lastcomment)
-			lastcomment = False
-			res2.append([lineno, line_text])
+		if inprelude:
+			if starts(line_text, '/'):
+				yield chunk
+				chunk = []
+				inprelude = False
+		elif titled and is_ch_sep(line_text):
+			yield chunk
+			chunk = []
+			titled = False
+		if not inprelude and len(line_text) > 2 and line_text[:2] == '##':
+			titled = True
+		chunk.append(noline)
+	if inprelude or chunk:
+		yield chunk
+
+# (Iterable String, ChNum, String, BuildContext) -> Book
+def parse(lines, chnum=None, basedir=None, ctx=None):
+	if ctx is None:
+		ctx = BuildContext()
+	numlines = enumerate(lines, 1)
+	if chnum:
+		return parse_selected(list(numlines), chnum, basedir, ctx)
+	# reading and comment stripping happen as parse_chs pulls each chapter
+	chunks = timed(ctx, "comments", split_chapters(collapse_blanks(strip_comments(numlines))))
+	with phase(ctx, "parse"):
+		(prelude, rest) = parse_prelude(next(chunks), ctx)
+		chs = parse_chs(chain([rest], chunks), ctx)
+	with phase(ctx, "resolve"):
+		deps = resolve_transclusions(ctx.all_chs)
+		includes = resolve_includes(chs, basedir or os.getcwd(), ctx.include_cache_dir, ctx.including)
+	return Book(prelude, chs, deps, includes, ctx)
 
-	return res2
+#=================
+# Chapter seeking
+#=================
 
-def parse(lines, chnum=None):
-	i = 1
-	numlines = []
-	for line in lines:
-		numlines.append((i, line))
-		i += 1
-	lines = remove_comments(numlines)
-	(prelude, lines) = parse_prelude(lines)
-	(chs,lines) = parse_chs(lines, chnum)
-	return Book(prelude, chs)
+# Finds every chapter from its separator and title lines alone, without
+# parsing anything.
+# [(Int, String)] -> [(ChNum, Int, Int)]
+def index_chapters(numlines):
+	seps = [i for (i, noline) in enumerate(numlines) if is_ch_sep(noline[1])]
+	index = []
+	for (k, start) in enumerate(seps):
+		end = seps[k+1] if k+1 < len(seps) else len(numlines)
+		for (_, line_text) in numlines[start+1:end]:
+			if len(line_text) > 2 and line_text[:2] == '##':
+				index.append((parse_title(line_text)[0], start, end))
+				break
+	return index
+
+# A chapter spec is a chapter number, a range of them in book order ("3-5"),
+# or a comma separated list of either ("1,4-6,9").
+# ([(ChNum, Int, Int)], String) -> [ChNum]
+def select_chapters(index, spec):
+	nums = [num for (num, _, _) in index]
+	selected = []
+	for item in spec.split(','):
+		item = item.strip()
+		if item in nums:
+			picked = [item]
+		elif '-' in item and all(x.strip() in nums for x in item.split('-', 1)):
+			(first, last) = [nums.index(x.strip()) for x in item.split('-', 1)]
+			picked = nums[first:last+1]
+		else:
+			error("Chapter %s not found" % item)
+		selected += [num for num in picked if num not in selected]
+	return selected
+
+# Parses only the selected chapters and whatever they transclude, using the
+# chapter index to jump straight to each one.
+def parse_selected(numlines, spec, basedir, ctx):
+	with phase(ctx, "comments"):
+		index = index_chapters(numlines)
+		start = index[0][1] if index else len(numlines)
+		prelines = remove_comments(numlines[:start])
+	with phase(ctx, "parse"):
+		(prelude, _) = parse_prelude(prelines, ctx)
+	selected = select_chapters(index, spec)
+	spans = dict((num, (s, e)) for (num, s, e) in index)
+
+	parsed = {}
+	todo = list(selected)
+	while todo:
+		num = todo.pop(0)
+		if num in parsed:
+			continue
+		(s, e) = spans[num]
+		with phase(ctx, "comments"):
+			chlines = remove_comments(numlines[s:e])
+		with phase(ctx, "parse"):
+			chs = parse_chs([chlines], ctx)
+		parsed[num] = chs
+		for ch in chs:
+			todo += [dep for dep in node_transclusions(flatten(flatten(ch.chunks))) if dep in spans]
+
+	with phase(ctx, "resolve"):
+		deps = resolve_transclusions(ctx.all_chs)
+		includes = resolve_includes(flatten(parsed.values()), basedir or os.getcwd(), ctx.include_cache_dir, ctx.including)
+	chs = flatten([parsed[num] for num in selected])
+	return Book(prelude, chs, deps, includes, ctx)
+
+#==========
+# Includes
+#==========
+
+# %include path.text[#chapter] pulls chapters in from another file. Included
+# files are parsed once per process (INCLUDE_CACHE) and, when the build has an
+# output directory, once per change across builds (include_cache_dir). Both are
+# keyed by path and checked against the mtime/size of every file the include
+# pulled in, so an edit anywhere down the chain reparses it.
+
+# String -> (String, ChNum)
+def split_include(spec):
+	(path, _, chnum) = (spec or '').strip().partition('#')
+	if not path:
+		error("Expected file name in %%include '%s'" % spec)
+	return (path, chnum or None)
+
+def file_stamp(path):
+	st = os.stat(path)
+	return (st.st_mtime_ns, st.st_size)
+
+def node_to_data(n):
+	content = n.content
+	if isinstance(content, list):
+		content = [node_to_data(c) for c in content]
+	return (n.tag, content, n.other, n.lineno, n.chlineno, n.chunkstart)
+
+def node_from_data(d):
+	(tag, content, other, lineno, chlineno, chunkstart) = d
+	if isinstance(content, list):
+		content = [node_from_data(c) for c in content]
+	n = Node(tag, content, other)
+	(n.lineno, n.chlineno, n.chunkstart) = (lineno, chlineno, chunkstart)
+	return n
+
+def include_cache_file(path, cache_dir):
+	return cache_dir + hashlib.sha1(path.encode('utf-8')).hexdigest() + ".pickle"
+
+def read_include_cache(path, cache_dir):
+	if not cache_dir:
+		return None
+	try:
+		with open(include_cache_file(path, cache_dir), 'rb') as f:
+			(chs, deps) = pickle.load(f)
+	except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+		return None
+	chs = [(num, [[node_from_data(d) for d in para] for para in paras]) for (num, paras) in chs]
+	return (chs, deps)
+
+def write_include_cache(path, entry, cache_dir):
+	if not cache_dir:
+		return
+	(chs, deps) = entry
+	data = ([(num, [[node_to_data(n) for n in para] for para in paras]) for (num, paras) in chs], deps)
+	mkdirp(cache_dir)
+	fname = include_cache_file(path, cache_dir)
+	tmpname = "%s.%d.%d.tmp" % (fname, os.getpid(), threading.get_ident())
+	with open(tmpname, 'wb') as f:
+		pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+	os.replace(tmpname, fname)
+
+def include_fresh(entry):
+	return all(os.path.exists(p) and file_stamp(p) == stamp for (p, stamp) in entry[1].items())
+
+# Parses an included file on its own, without touching the including book's
+# chapters or global pragmas, and flattens its transclusions since its chapter
+# numbers mean nothing to the host.
+# (String, String) -> ([(ChNum, [Para])], {String: Stamp})
+def parse_include(path, cache_dir, including=()):
+	debug("Parsing include %s" % path)
+	deps = {path: file_stamp(path)}
+	ctx = BuildContext(cache_dir)
+	ctx.including = including + (path,)
+	with open(path) as f:
+		book = parse((line.strip() for line in f), None, os.path.dirname(path), ctx)
+	deps.update(book.includes)
+	chs = [(ch.num, expand_transclusions(flatten(ch.chunks), ctx.all_chs)) for ch in book.chs]
+	return (chs, deps)
+
+# A file that is already being included further up is an include cycle
+def load_include(path, cache_dir, including=()):
+	path = os.path.abspath(path)
+	if path in including:
+		cycle = including[including.index(path):] + (path,)
+		error("Include cycle: %s" % " -> ".join(cycle))
+	for entry in (INCLUDE_CACHE.get(path), read_include_cache(path, cache_dir)):
+		if entry and include_fresh(entry):
+			INCLUDE_CACHE[path] = entry
+			return entry
+	entry = parse_include(path, cache_dir, including)
+	INCLUDE_CACHE[path] = entry
+	write_include_cache(path, entry, cache_dir)
+	return entry
+
+# Replaces every %include paragraph with the included paragraphs and returns
+# the files the book now depends on with their stamps.
+# ([Chapter], String, String, (String)) -> {String: Stamp}
+def resolve_includes(chs, basedir, cache_dir=None, including=()):
+	deps = {}
+	for ch in chs:
+		for paras in ch.chunks:
+			i = 0
+			while i < len(paras):
+				spec = include_of(paras[i])
+				if spec is None:
+					i += 1
+					continue
+				(path, chnum) = split_include(spec)
+				(inchs, indeps) = load_include(os.path.join(basedir, path), cache_dir, including)
+				deps.update(indeps)
+				if chnum is None:
+					included = flatten([p for (_, p) in inchs])
+				else:
+					matches = [p for (num, p) in inchs if num == chnum]
+					if not matches:
+						error("Cannot include chapter %s from %s, not found" % (chnum, path))
+					included = matches[0]
+				lineno = paras[i][0].lineno
+				paras[i:i+1] = [IncludedPara(p, lineno, k == 0) for (k, p) in enumerate(included)]
+				i += len(included)
+	return deps
 
 def replace_html(s):
 	return s.replace("---",'—').replace("(TM)","™")
@@ -1333,23 +1820,23 @@ def esc_latex(s):
 def mk_tex_author(x):
 	return "\\hfill{\\Large\\scshape{}\\let\\clearpage\\relax "+x+"}\\cleartoverso"
 
-def mk_tex_title(x):
-	if PRINT_NUMBERING:
+def mk_tex_title(x, ctx):
+	if ctx.print_numbering:
 		pre = "\\frontmatter"
 	else:
 		pre = "\\mainmatter"
-	if ALT_STYLE:
+	if ctx.alt_style:
 		return pre + "\\thispagestyle{empty}\\mbox{}\\vspace{2in}\\noindent\\begin{flushright}{\\HUGE\\chapfont\\let\\clearpage\\relax " + x + "}\\\\\n\\end{flushright}\\vspace{6\\baselineskip}"
 	else:
 		return pre + "\\thispagestyle{empty}\\mbox{}\\vspace{2in}\\noindent\\begin{flushright}{\\HUGE\\scshape{}\\let\\clearpage\\relax " + x + "}\\\\\n\\end{flushright}\\vspace{6\\baselineskip}"
 
-def mk_tex_chstyle(root):
+def mk_tex_chstyle(root, ctx):
 	pre = """
 \\newfontfamily\\altfont[ Path = %s/font/ ]{TwitterColorEmoji-SVGinOT}
 \\newfontfamily\\altfonts[ Path = %s/font/, Ligatures = TeX ]{DejaVuSansMono}
 """ % (root,root)
 
-	if ALT_STYLE:
+	if ctx.alt_style:
 		fontstr = """
 \\newfontfamily\\chapfont[ Path = %s/font/ ]{IStillKnow}
 \\newfontfamily\\letterfont[ Path = %s/font/ ]{RudelsbergAlternate}
@@ -1433,13 +1920,13 @@ def lettrinize(s):
 			restword = firstword[1:]
 		return "\\lettrine{\\letterfont "+firstword[0]+"}{" + esc_latex(restword) + '}' + ' ' + rest
 
-def render_prelude_pdf(root, texfile, texsrcdir, prelude, title_override):
+def render_prelude_pdf(root, texfile, texsrcdir, prelude, title_override, ctx):
 	titlefile = texsrcdir+"title.tex"
 	authorfile = texsrcdir+"author.tex"
 	headerfile = texsrcdir+"header.tex"
 	chstylefile = texsrcdir+'chstylef.tex'
 
-	title = mk_tex_title(prelude.title or '')
+	title = mk_tex_title(prelude.title or '', ctx)
 	author = mk_tex_author(prelude.author or '')
 
 	if title_override:
@@ -1449,7 +1936,7 @@ def render_prelude_pdf(root, texfile, texsrcdir, prelude, title_override):
 	rmfile((texfile,titlefile,authorfile,chstylefile))
 	writefile(titlefile,title)
 	writefile(authorfile,author)
-	writefile(chstylefile,mk_tex_chstyle(root))
+	writefile(chstylefile,mk_tex_chstyle(root, ctx))
 	writefile(headerfile,'')
 	#print("PARSED: %s" % book)
 
@@ -1457,7 +1944,7 @@ def render_ch_pdf(ch,num_chs):
 	return '\\chapter{' + ch.label + '}\n\n'
 
 # Chunk -> String
-def render_text_pdf(t, para_callback, same_speaker):
+def render_text_pdf(t, para_callback, same_speaker, ctx):
 	tag = t.tag
 	if tag == 'LINE':
 		return '\n'
@@ -1466,7 +1953,7 @@ def render_text_pdf(t, para_callback, same_speaker):
 	elif tag == 'REGULAR':
 		ch_line_num = t.chlineno
 		chunk_num = t.chunkstart
-		if chunk_num == 0 and ch_line_num == 0 and USE_LETTRINE:
+		if chunk_num == 0 and ch_line_num == 0 and ctx.use_lettrine:
 			text = t.content
 			return lettrinize(text)
 		else:
@@ -1482,7 +1969,7 @@ def render_text_pdf(t, para_callback, same_speaker):
 	elif tag =='DIALOG':
 		ch_line_num = t.chlineno
 		chunk_num = t.chunkstart
-		if chunk_num == 0 and ch_line_num == 0 and USE_LETTRINE:
+		if chunk_num == 0 and ch_line_num == 0 and ctx.use_lettrine:
 			return lettrinize(t.content[0].content) + "''"
 		else:
 			ren = '``' + para_callback(t.content)
@@ -1502,11 +1989,6 @@ def render_text_pdf(t, para_callback, same_speaker):
 			return "\\par\\bigskip\n\n"
 		elif t.content == 'lit':
 			return t.other
-		elif t.content == 'transclude':
-			if t.other not in ALL_CHS:
-				error("Cannot transclude chapter %s, not found" % t.other)
-			else:
-				return para_callback(ALL_CHS[t.other])
 		else:
 			error("Unknown pragma '%s'" % t.content)
 	elif tag == 'BEAT_SEP':
@@ -1523,12 +2005,11 @@ def render_ch_epub(ch, num_chs):
 		label = ch.label
 	return "<div class='title'>" + label + "</div>"
 
-def render_prelude_html(prelude):
-	#@font-face {
-	#	font-family: 'Cardo';
-	#	src: url('E:/time/font/Cardo-regular.ttf') format('truetype');
-	#}
-	stylesheet = """
+#@font-face {
+#	font-family: 'Cardo';
+#	src: url('E:/time/font/Cardo-regular.ttf') format('truetype');
+#}
+HTML_STYLE = """
 
 	body {
 		background-color: #201000;
@@ -1560,19 +2041,26 @@ def render_prelude_html(prelude):
 		color: #7766BB;
 	}
 """
+
+# Everything up to the opening of the body. root leads back to outdir from
+# pages kept in a directory below it
+def render_head_html(prelude, root="", extra=""):
 	return f"""
 	<!--DATE:{prelude.date or "NO DATE"}-->
 	<!--TITLE:{prelude.title or "NO TITLE"}-->
 <html>
 	<head>
 		<meta charset="UTF-8">
-		<script type="text/javascript" src="live.js"></script>
+		<script type="text/javascript" src="{root}live.js"></script>{extra}
 		<style>
-		{stylesheet}
+		{HTML_STYLE}
 		</style>
 	</head>
 	<body>
-		<h1>{prelude.title}</h1>
+"""
+
+def render_prelude_html(prelude):
+	return render_head_html(prelude) + f"""		<h1>{prelude.title}</h1>
 		<div class="author">by {prelude.author}</div>
 """ 
 
@@ -1583,7 +2071,7 @@ def render_ch_html(ch, num_chs):
 		label = ch.label
 	return "<h3>" + label + "</h3>"
 
-def render_text_html(t, para_callback,same_speaker):
+def render_text_html(t, para_callback,same_speaker, ctx):
 	tag = t.tag
 	if tag == 'LINE':
 		return '<br/>'
@@ -1617,11 +2105,6 @@ def render_text_html(t, para_callback,same_speaker):
 			return "<br/><br/>"
 		elif t.content == 'lit':
 			return ""#t.other # no latex pragmas needed
-		elif t.content == 'transclude':
-			if t.other not in ALL_CHS:
-				error("Cannot transclude chapter %s, not found" % t.other)
-			else:
-				return para_callback(ALL_CHS[t.other])
 		else:
 			error("Unknown pragma '%s'" % t.content)
 	elif tag == 'BEAT_SEP':
@@ -1638,6 +2121,64 @@ def render_closing_html():
 	</html>
 """
 
+# Paginated html (--paginate): <proj>.html is a table of contents and every
+# chapter gets a page in <proj>.pages/, named after its number so that
+# editing one chapter leaves the other pages as they were
+
+# (Chapter, Int) -> String
+def page_name(ch, k):
+	return re.sub(r'[^\w.-]', '_', chapter_key(ch, k)) + ".html"
+
+def render_nav_html(proj, names, k):
+	links = []
+	if k > 0:
+		links.append(f'<a href="{names[k-1]}">Previous</a>')
+	links.append(f'<a href="../{proj}.html">Contents</a>')
+	if k < len(names) - 1:
+		links.append(f'<a href="{names[k+1]}">Next</a>')
+	return "\t\t<p>" + " | ".join(links) + "</p>\n"
+
+# The next page is only fetched once this one has loaded, if at all
+def render_page_html(prelude, proj, names, k, body, prefetch=False):
+	extra = ""
+	if prefetch and k < len(names) - 1:
+		extra = f'\n\t\t<link rel="prefetch" href="{names[k+1]}">'
+	nav = render_nav_html(proj, names, k)
+	return render_head_html(prelude, "../", extra) + nav + body + "\n" + nav + "\t</body>\n\t</html>\n"
+
+def render_toc_html(prelude, proj, chs):
+	items = "".join(f'\t\t\t<li><a href="{proj}.pages/{page_name(ch, k)}">{ch.label or ch.num or k+1}</a></li>\n' for (k, ch) in enumerate(chs))
+	return render_prelude_html(prelude) + "\t\t<ol>\n" + items + "\t\t</ol>\n" + render_closing_html()
+
+# {String: String} of page name to page
+def render_pages(renderer, proj, prefetch=False):
+	chs = renderer.book.chs
+	names = [page_name(ch, k) for (k, ch) in enumerate(chs)]
+	pages = dict()
+	for (k, ch) in enumerate(chs):
+		body = renderer.render_chapter(ch)
+		pages[names[k]] = replace_html(render_page_html(renderer.book.prelude, proj, names, k, body, prefetch))
+	return pages
+
+# Writes the pages that changed and removes those of chapters that are gone,
+# along with their compressed copies. Returns how many pages were written.
+def write_pages(pagedir, pages):
+	mkdirp(pagedir)
+	for fname in os.listdir(pagedir):
+		if ".html" in fname and fname[:fname.index(".html")+5] not in pages:
+			os.remove(pagedir + fname)
+	return sum(write_if_changed(pagedir + name, page) for (name, page) in pages.items())
+
+# Where each chapter page starts, for the search index to link to the page a
+# line is on: [[Int, String]] by first line
+def page_starts(chs):
+	starts = []
+	for (k, ch) in enumerate(chs):
+		lines = [para_lineno(para) for para in flatten(ch.chunks) if para]
+		if lines:
+			starts.append([min(lines), page_name(ch, k)])
+	return sorted(starts)
+
 def render_prelude_txt(prelude):
 	return f"""
 {prelude.title}
@@ -1652,7 +2193,7 @@ def render_ch_txt(ch,num_chs):
 	else:
 		return "******\n" + ch.label.upper() + "\n******\n\n"
 
-def render_text_txt(t, para_callback,same_speaker):
+def render_text_txt(t, para_callback,same_speaker, ctx):
 	tag = t.tag
 	if tag == 'LINE':
 		return '\n'
@@ -1686,11 +2227,6 @@ def render_text_txt(t, para_callback,same_speaker):
 			return "\n\n"
 		elif t.content == 'lit':
 			return t.other
-		elif t.content == 'transclude':
-			if t.other not in ALL_CHS:
-				error("Cannot transclude chapter %s, not found" % t.other)
-			else:
-				return para_callback(ALL_CHS[t.other])
 		else:
 			error("Unknown pragma '%s'" % t.content)
 	elif tag == 'BEAT_SEP':
@@ -1699,52 +2235,209 @@ def render_text_txt(t, para_callback,same_speaker):
 		error("Unexpected node tag '%s'" % tag)
 	return str(t)
 
+#==============
+# Render cache
+#==============
+
+# Rendered paragraphs are cached by a Merkle hash of their nodes, so after an
+# edit only the paragraphs that changed are rendered again. The cache is kept
+# on disk per project and format under <outdir>/render-cache/ and is thrown
+# away whenever the book's pragmas or this file change.
+
+# A node's hash covers its tag, other, whether it opens the chapter (for
+# lettrines) and either its text or its children's hashes. Paragraphs with an
+# inline transclusion depend on another chapter and get None.
+# Node -> bytes
+def node_hash(n):
+	if not isinstance(n.content, list):
+		return leaf_hash(n)
+	hashes = {}
+	stack = [(n, False)]
+	while stack:
+		(m, ready) = stack.pop()
+		if not ready:
+			stack.append((m, True))
+			stack.extend((c, False) for c in m.content if isinstance(c.content, list))
+			continue
+		h = hashlib.sha1(node_header(m))
+		for c in m.content:
+			ch = hashes[id(c)] if isinstance(c.content, list) else leaf_hash(c)
+			if ch is None:
+				return None
+			h.update(ch)
+		hashes[id(m)] = h.digest()
+	return hashes[id(n)]
+
+def node_header(n):
+	return ("%s\0%s\0%d\0" % (n.tag, n.other, n.chlineno == 0 and n.chunkstart == 0)).encode('utf-8')
+
+def leaf_hash(n):
+	if n.tag == 'PRAGMA' and n.content == 'transclude':
+		return None
+	return hashlib.sha1(node_header(n) + ("\1%s" % n.content).encode('utf-8')).digest()
+
+# Para -> bytes
+def para_hash(para):
+	h = hashlib.sha1()
+	for n in para:
+		nh = node_hash(n)
+		if nh is None:
+			return None
+		h.update(nh)
+	return h.digest()
+
+def render_cache_file(outdir, proj, outformat):
+	return outdir + "render-cache/" + proj + "." + outformat + ".pickle"
+
+def render_cache_stamp(ctx):
+	return (file_stamp(os.path.abspath(__file__)), ctx.use_lettrine, ctx.alt_style, ctx.print_numbering)
+
+def read_render_cache(fname, ctx):
+	if not fname:
+		return {}
+	try:
+		with open(fname, 'rb') as f:
+			(stamp, fragments) = pickle.load(f)
+	except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+		return {}
+	return fragments if stamp == render_cache_stamp(ctx) else {}
+
+# Only the fragments this build used are kept, so the cache never outgrows the
+# book
+def write_render_cache(fname, renderer):
+	if not fname:
+		return
+	mkdirp(os.path.dirname(fname))
+	tmpname = "%s.%d.%d.tmp" % (fname, os.getpid(), threading.get_ident())
+	with open(tmpname, 'wb') as f:
+		pickle.dump((render_cache_stamp(renderer.ctx), renderer.used), f, pickle.HIGHEST_PROTOCOL)
+	os.replace(tmpname, fname)
+
 class Renderer:
-	def __init__(self, book, render_func, render_ch):
+	def __init__(self, book, render_func, render_ch, ctx=None, para_cache=None):
 		self.book = book
+		self.ctx = ctx or book.ctx
 		self.render_func = render_func
 		self.render_ch = render_ch
 		self.num_chs = len(book.chs)
+		self.fragments = {}
+		self.para_cache = para_cache if para_cache is not None else {}
+		self.used = {}
+		self.depth = 0
+		# how many transclusions are being rendered right now
+		self.transcluding = 0
 	
 	def render(self) -> str:
 		return self.render_chs(self.book.chs)
 
 	def render_chs(self, chs) -> str:
-		acc = ''
-		for ch in chs:
-			acc += self.render_ch(ch,self.num_chs)
-			prev = None
-			for para in ch.chunks:
-				acc += self.render_paras(para)
-
-				prev = para
-		return acc
+		return ''.join([self.render_chapter(ch) for ch in chs])
+
+	def render_chapter(self, ch) -> str:
+		stats = self.ctx.chapter_stats
+		if stats is not None:
+			start = time.perf_counter()
+		acc = [self.render_ch(ch,self.num_chs)]
+		for para in ch.chunks:
+			acc.append(self.render_paras(para))
+		rendered = ''.join(acc)
+		if stats is not None:
+			stats.render(ch, time.perf_counter() - start, rendered)
+		return rendered
 	
-	def render_paras(self, para) -> str:
-		acc = ''
+	# next_dtag is the dialog tag of whatever follows para, so the last
+	# paragraph of a transcluded chapter can continue into its host
+	def render_paras(self, para, next_dtag=None) -> str:
+		acc = []
 		i = 0
 		while i < len(para):
 			cur = para[i]
+			if i < len(para) - 1:
+				dtag_next = self.lead_dialog_tag(para, i+1, next_dtag)
+			else:
+				dtag_next = next_dtag
+			trans = transclusion_of(cur)
+			if trans is not None:
+				acc.append(self.render_transclusion(trans, dtag_next))
+				i += 1
+				continue
 			dtag = self.get_dialog_tag(cur)
 			same_speaker = False
-			if i < len(para) - 1:
-				next = para[i+1]
-				dtag_next = self.get_dialog_tag(next)
-				if dtag and dtag == dtag_next:
-					same_speaker = True
-			rendered = self.render_para(cur,same_speaker) + '\n' + '\n'
-			acc += rendered
+			if dtag and dtag == dtag_next:
+				same_speaker = True
+			acc.append(self.render_cached(cur,same_speaker))
+			acc.append('\n\n')
 			i += 1
-		return acc
+		return ''.join(acc)
 	
+	# The key also holds the same-speaker flag, which comes from the next
+	# paragraph, and the nesting depth, which decides the HTML <p> wrapper
+	def render_cached(self, para, same_speaker=False) -> str:
+		phash = para_hash(para)
+		if phash is None:
+			return self.render_para(para, same_speaker)
+		key = (phash, same_speaker, self.depth)
+		rendered = self.para_cache.get(key)
+		if rendered is None:
+			rendered = self.render_para(para, same_speaker)
+		self.used[key] = rendered
+		return rendered
+
+	# Nested content is rendered bottom-up rather than by recursion: every
+	# content list in the paragraph is collected breadth first and rendered in
+	# reverse, so by the time render_func asks for a node's content through
+	# para_callback it has already been rendered.
 	# [Chunk] -> String
 	def render_para(self, para, same_speaker=False) -> str:
-		acc = ''
+		lists = [para]
+		for chunks in lists:
+			for t in chunks:
+				if isinstance(t.content, list):
+					lists.append(t.content)
+		done = {}
+		callback = lambda content: done[id(content)]
+		for chunks in reversed(lists[1:]):
+			done[id(chunks)] = self.render_chunks(chunks, False, callback)
+		return self.render_chunks(para, same_speaker, callback)
+
+	def render_chunks(self, chunks, same_speaker, callback) -> str:
+		acc = []
 		i = 0
-		for t in para:
-			acc += self.render_func(t,self.render_para,same_speaker and i == len(para) - 1)
+		for t in chunks:
+			if t.tag == 'PRAGMA' and t.content == 'transclude':
+				acc.append(self.render_transclusion(t.other, None, True))
+			elif t.tag == 'PRAGMA' and t.content == 'include':
+				error("%%include %s must be on a line of its own" % t.other)
+			else:
+				acc.append(self.render_func(t,callback,same_speaker and i == len(chunks) - 1, self.ctx))
 			i += 1
-		return acc#.strip()
+		return ''.join(acc)
+
+	def transcluded(self, num):
+		if num not in self.ctx.all_chs:
+			error("Cannot transclude chapter %s, not found" % num)
+		return flatten(self.ctx.all_chs[num])
+
+	# Each transcluded chapter is rendered once per renderer for a given
+	# following speaker and reused wherever it is transcluded again
+	def render_transclusion(self, num, next_dtag=None, inline=False) -> str:
+		key = (num, next_dtag, inline)
+		if key not in self.fragments:
+			self.transcluding += 1
+			try:
+				self.fragments[key] = self.render_paras(self.transcluded(num), next_dtag)
+			finally:
+				self.transcluding -= 1
+		return self.fragments[key]
+
+	# Dialog tag of paras[i], looking through transclusions
+	def lead_dialog_tag(self, paras, i, after=None):
+		if i >= len(paras):
+			return after
+		trans = transclusion_of(paras[i])
+		if trans is None:
+			return self.get_dialog_tag(paras[i])
+		return self.lead_dialog_tag(self.transcluded(trans), 0, self.lead_dialog_tag(paras, i+1, after))
 
 	def get_dialog_tag(self, para):
 		for p in para:
@@ -1760,12 +2453,22 @@ class Renderer:
 		return last.other
 
 class HTMLRenderer(Renderer):
-	DEPTH = 0
+	# <a id="L<line>"> before every paragraph, for the search index to link to.
+	# Transcluded copies get none, so each id is only on the paragraph's own
+	# chapter.
+	anchors = False
+
+	def render_cached(self, para, same_speaker=False) -> str:
+		rendered = super().render_cached(para, same_speaker)
+		if self.anchors and self.depth == 0 and not self.transcluding and para_anchored(para):
+			return f'<a id="L{para_lineno(para)}"></a>' + rendered
+		return rendered
+
 	def render_para(self, para, same_speaker=False) -> str:
-		HTMLRenderer.DEPTH += 1
+		self.depth += 1
 		result =  super().render_para(para, same_speaker)
-		HTMLRenderer.DEPTH -= 1 
-		if HTMLRenderer.DEPTH == 0:
+		self.depth -= 1 
+		if self.depth == 0:
 			result = f"<p>{result}</p>"
 		return result
 
@@ -1774,21 +2477,105 @@ class EpubRenderedHTML:
 		self.chs = chs
 class EpubRenderedCh:
 	basename = "section"
-	i = 3
+	first = 3 # 1 and 2 are the title page and table of contents
 	@staticmethod
 	def get_url(k):
 		return f"{EpubRenderedCh.basename}{k:04}.html"
-	def __init__(self, name, content):
+	def __init__(self, name, content, index):
 		self.name = name
 		self.content = content
-		self.index = EpubRenderedCh.i
-		self.url = EpubRenderedCh.get_url(EpubRenderedCh.i)
-		EpubRenderedCh.i += 1
+		self.index = index
+		self.url = EpubRenderedCh.get_url(index)
 
 def render_test(parsed):
 	renderer = Renderer(parsed,render_text_pdf,render_ch_pdf)
 	return renderer.render()
 
+#==============
+# Search index
+#==============
+
+# The full-text index of every story built with --search lives in
+# <outdir>/search/: stories.json lists the stories and which shards hold
+# their words, and <prefix>.json maps each word starting with prefix to
+# {story: [paragraph line numbers]}. A browser only fetches the shards of
+# the words it looks up. Rebuilding one story rewrites only the shards its
+# old or new words are in.
+
+SEARCH_LOCK = threading.Lock()
+SEARCH_WORD = re.compile(r"\w+(?:'\w+)*")
+SEARCH_PREFIX = 2
+
+# Para -> [String]
+def para_words(para):
+	words = []
+	nodes = list(para)
+	while nodes:
+		n = nodes.pop()
+		if isinstance(n.content, list):
+			nodes.extend(n.content)
+		elif n.tag == 'REGULAR' and n.content:
+			words += SEARCH_WORD.findall(n.content.lower())
+	return words
+
+# Paragraphs are found by the line they start on, which is also their anchor
+# in the HTML, and included paragraphs by their %include line. Transclusions
+# are indexed where their chapter is.
+# [Chapter] -> {String: {Int}}
+def story_postings(chs):
+	postings = defaultdict(set)
+	for ch in chs:
+		for para in flatten(ch.chunks):
+			if not para or transclusion_of(para) is not None:
+				continue
+			for word in set(para_words(para)):
+				postings[word].add(para_lineno(para))
+	return postings
+
+def read_json(fname, default):
+	if not os.path.exists(fname):
+		return default
+	with open(fname) as f:
+		return json.load(f)
+
+def write_json_atomic(fname, data):
+	writebytes_atomic(fname, json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+
+# Returns how many shards were rewritten. pages is where each chapter page
+# starts when the story is paginated.
+def update_search_index(searchdir, name, title, postings, pages=None):
+	byshard = defaultdict(dict)
+	for (word, lines) in postings.items():
+		byshard[word[:SEARCH_PREFIX]][word] = sorted(lines)
+	digest = hashlib.sha1(json.dumps(byshard, sort_keys=True).encode('utf-8')).hexdigest()
+	with SEARCH_LOCK:
+		mkdirp(searchdir)
+		stories = read_json(searchdir + "stories.json", {})
+		old = stories.get(name, {})
+		entry = {"title": title, "shards": sorted(byshard), "hash": digest}
+		if pages:
+			entry["pages"] = pages
+		if old == entry:
+			return 0
+		# a new title or pagination only changes stories.json
+		shards = set() if old.get("hash") == digest else set(old.get("shards", [])) | set(byshard)
+		for shard in shards:
+			fname = searchdir + shard + ".json"
+			index = read_json(fname, {})
+			for word in list(index):
+				index[word].pop(name, None)
+				if not index[word]:
+					del index[word]
+			for (word, lines) in byshard.get(shard, {}).items():
+				index.setdefault(word, {})[name] = lines
+			if index:
+				write_json_atomic(fname, index)
+			elif os.path.exists(fname):
+				os.remove(fname)
+		stories[name] = entry
+		write_json_atomic(searchdir + "stories.json", stories)
+		return len(shards)
+
 #=================
 # Build functions
 #=================
@@ -1890,23 +2677,8 @@ def write_manifest_epub(rendered, include_toc_page, prelude, uuid, outdir):
 	outcontent = outdir + "content.opf"
 	write_template(incontent, outcontent, UUID=uuid,TITLE=prelude.title,MANIFEST=xml.tostring(manifest, encoding="unicode"),SPINE=xml.tostring(spine,encoding="unicode"))
 
-def main():
-	root = None
-	infile = None
-	chapter = None
+def read_conf(conffile):
 	confdict = defaultdict(dict)
-
-	argpars = argparse.ArgumentParser()
-	argpars.add_argument("--conf")
-	argpars.add_argument("--proj")
-	argpars.add_argument("--format")
-	argpars.add_argument("--outdir")
-	args = argpars.parse_args()
-	conffile = "conf"
-	if args.conf:
-		conffile = args.conf
-	if not args.proj:
-		raise Exception("Expected --proj arg")
 	lines = [ line.strip() for line in open(conffile) if len(line) > 0 and line[0] != "#" and ('=' in line or '[' in line)]
 
 	curname = 'global'
@@ -1919,9 +2691,135 @@ def main():
 		else:
 			(lhs,rhs) = line.split("=")
 			confdict[curname][lhs] = rhs
-	proj = args.proj
+	return confdict
+
+# Build phases in the order they run; "other" is whatever none of them cover
+TIMED_PHASES = ["comments", "parse", "merge", "resolve", "tests", "cache", "render", "write", "compress", "search", "zip", "xelatex"]
+
+# ({String: Float}, Float) -> [(String, Float)]
+def timing_rows(times, total):
+	rows = [(name, times[name]) for name in TIMED_PHASES if name in times]
+	rows.append(("other", max(0.0, total - sum(secs for (_, secs) in rows))))
+	return rows
+
+def print_timings(proj, outformat, times, total):
+	print(f"Timings for {proj} ({outformat}):")
+	for (name, secs) in timing_rows(times, total):
+		print(f"  {name:<10} {secs*1000:10.1f}ms {secs/total*100 if total else 0:6.1f}%")
+	print(f"  {'total':<10} {total*1000:10.1f}ms")
+
+def write_timings(fname, proj, outformat, times, total):
+	data = {"project": proj, "format": outformat, "total": total, "phases": dict(timing_rows(times, total))}
+	writefile(fname, json.dumps(data, indent=1) + "\n")
+
+# [[Para]] -> (Int, Int)
+def count_nodes(chunks):
+	nodes = flatten(flatten(chunks))
+	count = 0
+	depth = max((n.depth() for n in nodes), default=0)
+	while nodes:
+		n = nodes.pop()
+		count += 1
+		if isinstance(n.content, list):
+			nodes.extend(n.content)
+	return (count, depth)
+
+# Words of running text, counted once per chapter: transclusions aren't
+# expanded
+# [Chapter] -> Int
+def word_count(chs):
+	nodes = flatten(flatten(flatten([ch.chunks for ch in chs])))
+	words = 0
+	while nodes:
+		n = nodes.pop()
+		if isinstance(n.content, list):
+			nodes.extend(n.content)
+		elif n.tag == 'REGULAR' and n.content:
+			words += len(n.content.split())
+	return words
+
+# What an index of the built stories needs, so it never has to open them
+def write_metadata(fname, proj, conf, book):
+	data = {"name": proj, "title": book.prelude.title, "author": book.prelude.author, "date": book.prelude.date,
+		"status": conf.get('status'), "words": word_count(book.chs), "chapters": len(book.chs)}
+	writefile(fname, json.dumps(data, indent=1) + "\n")
+
+# Unnumbered chapters go by their place in the book
+# (Chapter, Int) -> String
+def chapter_key(ch, k):
+	return ch.num or "ch%d" % (k+1)
+
+# One entry per chapter in book order. Render cost is kept per format, so
+# the numbers from the last build in each other format are carried over.
+def write_chapter_stats(fname, proj, book, stats):
+	old = dict()
+	if os.path.exists(fname):
+		try:
+			with open(fname) as f:
+				old = dict((ch['key'], ch) for ch in json.load(f)['chapters'])
+		except (OSError, ValueError, KeyError):
+			warn(f"Ignoring unreadable chapter stats {fname}")
+	chs = []
+	for (k, ch) in enumerate(book.chs):
+		(nodes, depth) = count_nodes(ch.chunks)
+		(lines, parse_secs) = stats.parsed.get(ch, (None, None))
+		key = chapter_key(ch, k)
+		prev = old.get(key, {})
+		entry = {"key": key, "num": ch.num, "label": ch.label, "lines": lines, "nodes": nodes, "max_depth": depth,
+			"parse": parse_secs, "render": prev.get("render", {}), "bytes": prev.get("bytes", {})}
+		if ch in stats.rendered:
+			(secs, size) = stats.rendered[ch]
+			entry["render"][stats.outformat] = secs
+			entry["bytes"][stats.outformat] = size
+		chs.append(entry)
+	data = {"project": proj, "format": stats.outformat, "chapters": chs}
+	writefile(fname, json.dumps(data, indent=1) + "\n")
+
+def write_epub(rendered, include_toc_page, prelude, uuid, epubdir):
+	write_toc_epub(rendered, include_toc_page, prelude, uuid, epubdir)
+	write_manifest_epub(rendered, include_toc_page, prelude, uuid, epubdir)
+	
+	cwd = os.getcwd()
+	meta_inf_from = cwd + "/" + EPUB_SRCDIR + "/META-INF"
+	meta_inf_to = epubdir +"/META-INF"
+	shutil.copytree(meta_inf_from, meta_inf_to, dirs_exist_ok=True)
+
+	cssname = "style.css"
+	incss = cwd + "/" + EPUB_SRCDIR + "/" + cssname
+	outcss = epubdir + "/" + cssname
+	shutil.copy2(incss, outcss)
+
+	intitle = EPUB_SRCDIR + "/" + "title_template.html"
+	outtitle = epubdir + "/" + EpubRenderedCh.get_url(1)
+	write_template(intitle, outtitle, TITLE=prelude.title, AUTHOR=prelude.author)
+
+	intoc = EPUB_SRCDIR + "/" + "toc_template.html"
+	outtoc = epubdir + "/" + EpubRenderedCh.get_url(2)
+	toccontent = ""
+	toccontent += f"<p style='margin:0'><a href='{EpubRenderedCh.get_url(1)}'>Title Page</a></p>\n"
+	toccontent += f"<p style='margin:0'><a href='{EpubRenderedCh.get_url(2)}'>Table of Contents</a></p>\n"
+	for c in rendered.chs:
+		toccontent += f"<p style='margin:0'><a href='{c.url}'>{c.name}</a></p>\n"
+	write_template(intoc, outtoc, CONTENT=toccontent)
+
+	
+	for c in rendered.chs:
+		url = c.url
+		outname = epubdir + "/" + url
+		print(f"writing {url} to {outname}")
+		write_template(EPUB_SRCDIR + "/" + "ch_template.html", outname, CONTENT= c.content)
+
+# Parses a project's input, or just its chapters when the conf selects some
+def read_book(conf, ctx=None):
+	infile = conf['input']
+	ctx = ctx or BuildContext()
+	ctx.including = (os.path.abspath(infile),)
+	with open(infile) as f:
+		return parse((line.strip() for line in f), conf.get('chapter'), os.path.dirname(os.path.abspath(infile)), ctx)
+
+def build(confdict, proj, outformat, outdir, opts=None):
+	opts = opts or BuildOptions()
 	conf = confdict[proj]
-	outformat = args.format or "txt"
 	if not 'root' in conf:
 		raise Exception(f"project {proj} not found (possibly invalid config)")
 	root = conf['root']
@@ -1932,101 +2830,192 @@ def main():
 	infile = conf['input']
 	chapter = conf['chapter'] if 'chapter' in conf else None
 
-	if not SKIP_TESTS:
-		run_tests()
-
 	chnum = None
 
 	if chapter:
 		chnum = chapter
 
-	lines = [line.strip() for line in open(infile)]
-
-	book = parse(lines, chnum)
+	ctx = BuildContext(outdir + "include-cache/" if outdir else None)
+	if opts.memprofile:
+		import memprofile
+		ctx.timer = PhaseTimer(memprofile.MemoryProfile())
+	elif opts.timings:
+		ctx.timer = PhaseTimer()
+	if opts.chapter_stats:
+		ctx.chapter_stats = ChapterStats(outformat)
+	start = time.perf_counter()
+	book = read_book(conf, ctx)
+	if opts.author:
+		book.prelude.author = opts.author
+	if not ctx.skip_tests:
+		with phase(ctx, "tests"):
+			run_tests_once()
+	if outdir:
+		# watch.py rebuilds when any of these change
+		writefile(outdir + proj + ".deps", "\n".join([infile] + sorted(book.includes)) + "\n")
+		write_metadata(outdir + proj + ".meta.json", proj, conf, book)
+	cachefile = render_cache_file(outdir, proj, outformat) if outdir else None
+	with phase(ctx, "cache"):
+		para_cache = read_render_cache(cachefile, ctx)
 	if outformat == "pdf":
 		texsrcdir = root + "pdf-src/"
 		mkdirp(texsrcdir)
 		texfile = texsrcdir+"text.tex"
-		pdfrenderer = Renderer(book,render_text_pdf,render_ch_pdf)
-		render_prelude_pdf(root, texfile, texsrcdir, book.prelude,chnum)
-		rendered = pdfrenderer.render()
-		writefile(texfile,rendered)
-		build_pdf(root,proj)
+		pdfrenderer = Renderer(book,render_text_pdf,render_ch_pdf,para_cache=para_cache)
+		with phase(ctx, "write"):
+			render_prelude_pdf(root, texfile, texsrcdir, book.prelude,chnum,ctx)
+		with phase(ctx, "render"):
+			rendered = pdfrenderer.render()
+		with phase(ctx, "write"):
+			writefile(texfile,rendered)
+		with phase(ctx, "cache"):
+			write_render_cache(cachefile, pdfrenderer)
+		with phase(ctx, "xelatex"):
+			build_pdf(root,proj)
 		
 	elif outformat == "txt":
-		outfile = args.outdir+args.proj + ".txt"
-		txtrenderer = Renderer(book, render_text_txt,render_ch_txt)
-		prelude = render_prelude_txt(book.prelude)
-		rendered = prelude + txtrenderer.render()
-		writefile(outfile, rendered)
+		outfile = outdir+proj + ".txt"
+		txtrenderer = Renderer(book, render_text_txt,render_ch_txt,para_cache=para_cache)
+		with phase(ctx, "render"):
+			prelude = render_prelude_txt(book.prelude)
+			rendered = prelude + txtrenderer.render()
+		with phase(ctx, "write"):
+			writefile(outfile, rendered)
+		with phase(ctx, "cache"):
+			write_render_cache(cachefile, txtrenderer)
 	elif outformat == "html":
-		outfile = args.outdir+args.proj+".html"
-		htmlrenderer = HTMLRenderer(book, render_text_html, render_ch_html)
-		prelude = render_prelude_html(book.prelude)
-		closing = render_closing_html()
-		rendered = prelude + htmlrenderer.render() + closing
-		rendered = replace_html(rendered)
-		writefile(outfile, rendered)
+		outfile = outdir+proj+".html"
+		htmlrenderer = HTMLRenderer(book, render_text_html, render_ch_html, para_cache=para_cache)
+		htmlrenderer.anchors = opts.search
+		pagedir = outdir + proj + ".pages/"
+		# a single chapter needs no contents page
+		paginate = opts.paginate and len(book.chs) > 1
+		pages = {}
+		with phase(ctx, "render"):
+			if paginate:
+				pages = render_pages(htmlrenderer, proj, opts.prefetch)
+				rendered = replace_html(render_toc_html(book.prelude, proj, book.chs))
+			else:
+				prelude = render_prelude_html(book.prelude)
+				closing = render_closing_html()
+				rendered = prelude + htmlrenderer.render() + closing
+				rendered = replace_html(rendered)
+		with phase(ctx, "write"):
+			write_if_changed(outfile, rendered)
+			if paginate:
+				write_pages(pagedir, pages)
+			elif os.path.isdir(pagedir):
+				shutil.rmtree(pagedir)
+		if opts.compress:
+			with phase(ctx, "compress"):
+				write_compressed(outfile, rendered)
+				for (name, page) in pages.items():
+					write_compressed(pagedir + name, page)
+		if opts.search:
+			with phase(ctx, "search"):
+				update_search_index(outdir + "search/", proj, book.prelude.title, story_postings(book.chs),
+					page_starts(book.chs) if paginate else None)
+		with phase(ctx, "cache"):
+			write_render_cache(cachefile, htmlrenderer)
 	elif outformat == "epub":
-		outdir = args.outdir + "epub-temp/"
-		shutil.rmtree(outdir)
-		mkdirp(outdir)
+		epubdir = outdir + "epub-temp/" + proj + "/"
+		shutil.rmtree(epubdir, ignore_errors=True)
+		mkdirp(epubdir)
 
 		uuid = UUID.uuid4()
-		htmlrenderer = HTMLRenderer(book, render_text_html, render_ch_epub)
+		htmlrenderer = HTMLRenderer(book, render_text_html, render_ch_epub, para_cache=para_cache)
 		numchs = len(htmlrenderer.book.chs)
 		include_toc_page = numchs > 1
 		chapters = []
-		for c in htmlrenderer.book.chs:
-			ch = htmlrenderer.render_ch(c, htmlrenderer.num_chs)
-			chname = c.label
-			for para in c.chunks:
-				ch += htmlrenderer.render_paras(para)
-			chapter = EpubRenderedCh(chname, ch)
-			chapters.append(chapter)
-		rendered = EpubRenderedHTML(chapters)
+		with phase(ctx, "render"):
+			for c in htmlrenderer.book.chs:
+				ch = htmlrenderer.render_chapter(c)
+				chname = c.label
+				chapter = EpubRenderedCh(chname, ch, EpubRenderedCh.first + len(chapters))
+				chapters.append(chapter)
+			rendered = EpubRenderedHTML(chapters)
+		with phase(ctx, "cache"):
+			write_render_cache(cachefile, htmlrenderer)
 		
-		write_toc_epub(rendered, include_toc_page, book.prelude, uuid, outdir)
-		write_manifest_epub(rendered, include_toc_page, book.prelude, uuid, outdir)
-		
-		cwd = os.getcwd()
-		meta_inf_from = cwd + "/" + EPUB_SRCDIR + "/META-INF"
-		meta_inf_to = outdir +"/META-INF"
-		shutil.copytree(meta_inf_from, meta_inf_to, dirs_exist_ok=True)
-
-		cssname = "style.css"
-		incss = cwd + "/" + EPUB_SRCDIR + "/" + cssname
-		outcss = outdir + "/" + cssname
-		shutil.copy2(incss, outcss)
-
-		intitle = EPUB_SRCDIR + "/" + "title_template.html"
-		outtitle = outdir + "/" + EpubRenderedCh.get_url(1)
-		write_template(intitle, outtitle, TITLE=book.prelude.title, AUTHOR=book.prelude.author)
-
-		intoc = EPUB_SRCDIR + "/" + "toc_template.html"
-		outtoc = outdir + "/" + EpubRenderedCh.get_url(2)
-		toccontent = ""
-		toccontent += f"<p style='margin:0'><a href='{EpubRenderedCh.get_url(1)}'>Title Page</a></p>\n"
-		toccontent += f"<p style='margin:0'><a href='{EpubRenderedCh.get_url(2)}'>Table of Contents</a></p>\n"
-		for c in rendered.chs:
-			toccontent += f"<p style='margin:0'><a href='{c.url}'>{c.name}</a></p>\n"
-		write_template(intoc, outtoc, CONTENT=toccontent)
+		with phase(ctx, "write"):
+			write_epub(rendered, include_toc_page, book.prelude, uuid, epubdir)
 
-		
-		for c in rendered.chs:
-			url = c.url
-			outname = outdir + "/" + url
-			print(f"writing {url} to {outname}")
-			write_template(EPUB_SRCDIR + "/" + "ch_template.html", outname, CONTENT= c.content)
-
-		outzip = args.outdir + "/" + proj
-		zip_folder(outdir, outzip + ".zip")
-		os.rename(outzip + '.zip', outzip + '.epub')
+		with phase(ctx, "zip"):
+			outzip = outdir + "/" + proj
+			zip_folder(epubdir, outzip + ".zip")
+			os.rename(outzip + '.zip', outzip + '.epub')
 			
 	else:
 		raise Exception(f"format '{outformat}' not implemented")
 
+	if opts.timings:
+		total = time.perf_counter() - start
+		print_timings(proj, outformat, ctx.timer.times, total)
+		if outdir:
+			write_timings(outdir + proj + ".timings.json", proj, outformat, ctx.timer.times, total)
+	if opts.memprofile:
+		memory = ctx.timer.memory
+		memory.stop()
+		memory.report(f"{proj} ({outformat})")
+		if outdir:
+			memory.write(outdir + proj + ".memory.json", project=proj, format=outformat)
+	if ctx.chapter_stats and outdir:
+		write_chapter_stats(outdir + proj + ".chapters.json", proj, book, ctx.chapter_stats)
 
+def main():
+	argpars = argparse.ArgumentParser()
+	argpars.add_argument("--conf")
+	argpars.add_argument("--proj", help="project name, or several separated by commas")
+	argpars.add_argument("--format")
+	argpars.add_argument("--outdir")
+	argpars.add_argument("--jobs", type=int, default=1, help="build this many projects at once")
+	argpars.add_argument("--timings", action="store_true", help="print time per build phase and write <outdir>/<proj>.timings.json")
+	argpars.add_argument("--chapter-stats", action="store_true", help="write per chapter size and cost to <outdir>/<proj>.chapters.json")
+	argpars.add_argument("--memprofile", action="store_true", help="report peak and retained memory per build phase and where it was allocated")
+	argpars.add_argument("--author", help="render this author name instead of the one in the book")
+	argpars.add_argument("--search", action="store_true", help="html: anchor every paragraph and add the book to <outdir>/search/")
+	argpars.add_argument("--compress", action="store_true", help="html: also write .gz and, with brotli installed, .br next to the output")
+	argpars.add_argument("--paginate", action="store_true", help="html: one page per chapter in <outdir>/<proj>.pages/, with <proj>.html as contents")
+	argpars.add_argument("--prefetch", action="store_true", help="html: with --paginate, have each page prefetch the next")
+	argpars.add_argument("--profile", nargs="?", const="parser.prof", help="write cProfile stats for the whole build to this file")
+	args = argpars.parse_args()
+	conffile = "conf"
+	if args.conf:
+		conffile = args.conf
+	if not args.proj:
+		raise Exception("Expected --proj arg")
+	confdict = read_conf(conffile)
+	projs = args.proj.split(",")
+	outformat = args.format or "txt"
+	opts = BuildOptions(args.timings, args.chapter_stats, args.memprofile, args.compress, args.author, args.search,
+		args.paginate, args.prefetch)
+
+	# pdf builds share pdf-src/ and book.tex so they always run one at a time,
+	# cProfile only sees the thread it was started in and tracemalloc can't
+	# tell builds in different threads apart
+	jobs = args.jobs if outformat != "pdf" and not args.profile and not args.memprofile else 1
+	if args.profile:
+		import cProfile
+		import pstats
+		profiler = cProfile.Profile()
+		profiler.enable()
+	try:
+		if jobs > 1 and len(projs) > 1:
+			# run_tests turns DEBUG off while it runs, which the builds in
+			# the pool would see, so it goes first even if they all skip it
+			run_tests_once()
+			with ThreadPoolExecutor(max_workers=jobs) as pool:
+				futures = [pool.submit(build, confdict, proj, outformat, args.outdir, opts) for proj in projs]
+				for f in futures:
+					f.result()
+		else:
+			for proj in projs:
+				build(confdict, proj, outformat, args.outdir, opts)
+	finally:
+		if args.profile:
+			profiler.disable()
+			profiler.dump_stats(args.profile)
+			pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
 
 
 if __name__ == '__main__':
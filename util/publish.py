@@ -1,27 +1,137 @@
 import sys
 import shutil
-import re
 import os
+import json
+import hashlib
 
 OUT_DIR = f"{os.environ['STORY_ROOT']}/out/"
 PUBLISH_DIR = f"{os.environ['STORY_ROOT']}/stories-published/"
-AUTHOR_OVERRIDE = "Sky"
+MANIFEST = PUBLISH_DIR + "manifest.json"
+# the html, the variants parser.py --compress writes next to it and the
+# metadata generate_index.py builds the index from
+EXTS = [".html", ".html.gz", ".html.br", ".meta.json"]
+# the search index parser.py --search keeps for all stories
+SEARCH_DIR = "search/"
+# the chapter pages of a story built with parser.py --paginate
+PAGES_DIR = ".pages/"
+PAGE_EXTS = (".html", ".html.gz", ".html.br")
+
+def hash_file(fname):
+	h = hashlib.sha256()
+	with open(fname, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 16), b''):
+			h.update(block)
+	return h.hexdigest()
+
+def read_manifest():
+	if not os.path.exists(MANIFEST):
+		return {}
+	try:
+		with open(MANIFEST) as f:
+			return json.load(f)
+	except ValueError:
+		print(f"WARNING: ignoring unreadable {MANIFEST}")
+		return {}
+
+def write_atomic(fname, write):
+	tmpname = "%s.%d.tmp" % (fname, os.getpid())
+	try:
+		write(tmpname)
+		os.replace(tmpname, fname)
+	finally:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+
+def write_manifest(manifest):
+	def write(tmpname):
+		with open(tmpname, 'w') as f:
+			json.dump(manifest, f, indent=1, sort_keys=True)
+	write_atomic(MANIFEST, write)
+
+# Publishes one output file if its contents changed since the last publish.
+# The source is only hashed when its mtime or size moved, the same way
+# count.py's file index avoids rereading files.
+# Returns "new", "changed" or None
+def publish_file(manifest, fname):
+	src = OUT_DIR + fname
+	dst = PUBLISH_DIR + fname
+	st = os.stat(src)
+	entry = manifest.get(fname)
+	if entry and os.path.exists(dst):
+		if (entry["mtime"], entry["size"]) == (st.st_mtime_ns, st.st_size):
+			return None
+		hash = hash_file(src)
+		if entry["hash"] == hash:
+			manifest[fname] = {"hash": hash, "mtime": st.st_mtime_ns, "size": st.st_size}
+			return None
+	else:
+		hash = hash_file(src)
+	os.makedirs(os.path.dirname(dst), exist_ok=True)
+	write_atomic(dst, lambda tmpname: shutil.copyfile(src, tmpname))
+	manifest[fname] = {"hash": hash, "mtime": st.st_mtime_ns, "size": st.st_size}
+	return "changed" if entry else "new"
+
+# Drops a published file whose source is gone, e.g. a .br from before
+# brotli was uninstalled
+def unpublish_file(manifest, fname):
+	if os.path.exists(PUBLISH_DIR + fname):
+		os.remove(PUBLISH_DIR + fname)
+	return "removed" if manifest.pop(fname, None) else None
+
+# Brings a published directory in line with the built one, file by file.
+# A directory that was not built unpublishes everything in it.
+# Returns [(change, fname)]
+def publish_dir(manifest, subdir, exts):
+	built = set()
+	if os.path.isdir(OUT_DIR + subdir):
+		built = set(subdir + f for f in os.listdir(OUT_DIR + subdir) if f.endswith(exts))
+	published = set(f for f in manifest if f.startswith(subdir))
+	changes = []
+	for fname in sorted(built | published):
+		change = publish_file(manifest, fname) if fname in built else unpublish_file(manifest, fname)
+		if change:
+			changes.append((change, fname))
+	if not built and os.path.isdir(PUBLISH_DIR + subdir) and not os.listdir(PUBLISH_DIR + subdir):
+		os.rmdir(PUBLISH_DIR + subdir)
+	return changes
+
+# Builds without --search leave the published index alone
+def publish_search(manifest):
+	if not os.path.isdir(OUT_DIR + SEARCH_DIR):
+		return []
+	return publish_dir(manifest, SEARCH_DIR, ".json")
 
 def main():
 	names = sys.argv[1:]
 	print("Publishing: " + ", ".join(names))
-	for n in names:
-		move_from = OUT_DIR + n + ".html"
-		move_to  = PUBLISH_DIR + n + ".html"
-		
-		shutil.copy(move_from, move_to)
-		if AUTHOR_OVERRIDE:
-			contents = open(move_to, "r").read()
-			replaced = re.sub('(<div class="author">by )(.+)(</div>)', fr'\1{AUTHOR_OVERRIDE}&nbsp;\3', contents) #nbsp in case the author's name already matches
-			if contents == replaced:
-				print(f"WARNING: author replace failed for {move_to}")
-			open(move_to, "w").write(replaced)
-
+	manifest = read_manifest()
+	changed = []
+	try:
+		for n in names:
+			if not os.path.exists(OUT_DIR + n + ".html"):
+				print(f"WARNING: {OUT_DIR}{n}.html not found, skipping")
+				continue
+			changes = []
+			for ext in EXTS:
+				fname = n + ext
+				if os.path.exists(OUT_DIR + fname):
+					change = publish_file(manifest, fname)
+				else:
+					change = unpublish_file(manifest, fname)
+				if change:
+					changes.append(f"{fname} {change}")
+			pages = publish_dir(manifest, n + PAGES_DIR, PAGE_EXTS)
+			if pages:
+				changes.append(f"{len(pages)} chapter page files updated")
+			if changes:
+				changed.append(n)
+				print(f"  {n}: " + ", ".join(changes))
+		search = publish_search(manifest)
+	finally:
+		write_manifest(manifest)
+	print(f"{len(changed)} of {len(names)} stories changed")
+	if search:
+		print(f"Search index: {len(search)} shards updated")
 
 if __name__ == '__main__':
-	main()
\ No newline at end of file
+	main()
@@ -0,0 +1,230 @@
+import os
+import re
+import sys
+import pickle
+import hashlib
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+
+import parser as P
+from concordance import conf_books, speaker_of
+
+# Markup-aware search over the books in the conf (util/textl search). Each
+# book's parsed chapters are kept in <outdir>/ast-cache/ in the same plain
+# tuple form as the include cache, and searched as tuples, so a warm query
+# never parses or builds a Node. A cache entry is reparsed when the book, a
+# file it includes or parser.py changed. Books are searched in parallel.
+#
+#   util/textl search 'tower' --tag italics
+#   util/textl search --speaker I --chapters 10-20 'sword'
+#   util/textl search --tag narration -i 'she said'
+#   util/textl search --todo
+
+OUT_DIR = os.environ.get('STORY_ROOT', '.') + "/out/"
+CACHE_DIR = "ast-cache/"
+# what --todo shows of the paragraph before the marker
+CONTEXT = 80
+
+# tags that start a line of their own
+BREAKS = ('LINE', 'BLOCK', 'DASHQUOTE')
+
+TAGS = ["dialog", "italics", "block", "smallcaps", "escape", "singquote", "doubquote", "dashquote", "narration"]
+
+class Query:
+	def __init__(self, pattern=None, tag=None, speaker=None, chapters=None, todo=False, ignore_case=False):
+		self.pattern = pattern
+		self.tag = tag.upper() if tag else None
+		self.speaker = speaker_of(speaker)
+		self.chapters = chapters
+		self.todo = todo
+		self.ignore_case = ignore_case
+
+	def compile(self):
+		return re.compile(self.pattern or '', re.IGNORECASE if self.ignore_case else 0)
+
+def cache_file(path, cachedir):
+	return cachedir + hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest() + ".pickle"
+
+def read_cache(path, cachedir):
+	try:
+		with open(cache_file(path, cachedir), 'rb') as f:
+			entry = pickle.load(f)
+	except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+		return None
+	return entry if P.include_fresh(entry) else None
+
+def write_cache(path, entry, cachedir):
+	P.mkdirp(cachedir)
+	fname = cache_file(path, cachedir)
+	tmpname = "%s.%d.tmp" % (fname, os.getpid())
+	with open(tmpname, 'wb') as f:
+		pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+	os.replace(tmpname, fname)
+
+# The whole book, as chapters of paragraphs of node data
+# (String, String) -> ([(ChNum, String, [[Data]])], {String: Stamp})
+def load_book(path, outdir):
+	cachedir = outdir + CACHE_DIR
+	entry = read_cache(path, cachedir)
+	if entry:
+		return entry
+	book = P.read_book({'input': path}, P.BuildContext(outdir + "include-cache/"))
+	deps = {os.path.abspath(path): P.file_stamp(path), os.path.abspath(P.__file__): P.file_stamp(P.__file__)}
+	deps.update(book.includes)
+	chs = [(ch.num, ch.label, [[P.node_to_data(n) for n in para] for para in P.flatten(ch.chunks)]) for ch in book.chs]
+	entry = (chs, deps)
+	write_cache(path, entry, cachedir)
+	return entry
+
+# Like parser.py's chapter spec, but chapters a book doesn't have just match
+# nothing, since one spec is applied to every book
+# ([ChNum], String) -> set(ChNum)
+def pick_chapters(nums, spec):
+	picked = set()
+	for item in spec.split(','):
+		item = item.strip()
+		if item in nums:
+			picked.add(item)
+		elif '-' in item:
+			(first, last) = [x.strip() for x in item.split('-', 1)]
+			if first in nums and last in nums:
+				picked.update(nums[nums.index(first):nums.index(last)+1])
+	return picked
+
+# Text is joined as it is in the source: markup adds no space, but the tags
+# that start a line of their own are a line break
+# Data -> String
+def data_text(d, skip=()):
+	parts = []
+	stack = [d]
+	while stack:
+		(tag, content) = stack.pop()[:2]
+		if tag in skip:
+			continue
+		if tag in BREAKS:
+			parts.append(' ')
+			stack.append(('REGULAR', ' '))
+		if isinstance(content, list):
+			stack.extend(reversed(content))
+		elif tag == 'REGULAR' and content:
+			parts.append(content)
+	return ' '.join(''.join(parts).split())
+
+def has_todo(para):
+	stack = list(para)
+	while stack:
+		d = stack.pop()
+		if d[0] == 'TODO':
+			return True
+		if isinstance(d[1], list):
+			stack.extend(d[1])
+	return False
+
+# The parts of a paragraph a query looks at, as [(lineno, text)]. Untagged
+# dialog takes the paragraph's only tagged speaker, as in the concordance.
+def para_scopes(para, q):
+	if not para:
+		return []
+	if q.tag is None and q.speaker is None:
+		return [(para[0][3], data_text(('PARA', para)))]
+	if q.tag == 'NARRATION':
+		return [(para[0][3], data_text(('PARA', para), ('DIALOG',)))]
+	tag = q.tag or 'DIALOG'
+	stack = list(para)
+	tagged = set()
+	while stack:
+		d = stack.pop()
+		if d[0] == 'DIALOG' and d[2]:
+			tagged.add(speaker_of(d[2]))
+		if isinstance(d[1], list):
+			stack.extend(d[1])
+	default = tagged.pop() if len(tagged) == 1 else None
+	scopes = []
+	stack = [(d, None) for d in reversed(para)]
+	while stack:
+		(d, speaker) = stack.pop()
+		if d[0] == 'DIALOG':
+			speaker = speaker_of(d[2]) or default
+		if d[0] == tag and (q.speaker is None or speaker == q.speaker):
+			scopes.append((d[3], data_text(d)))
+		elif isinstance(d[1], list):
+			stack.extend((c, speaker) for c in reversed(d[1]))
+	return scopes
+
+# [(String, Int, ChNum, String)] of path, line, chapter and text in book order
+def search_book(path, q, outdir):
+	(chs, _) = load_book(path, outdir)
+	pattern = q.compile()
+	picked = pick_chapters([num for (num, _, _) in chs], q.chapters) if q.chapters else None
+	hits = []
+	for (num, _, paras) in chs:
+		if picked is not None and num not in picked:
+			continue
+		last = ''
+		for para in paras:
+			if q.todo:
+				if has_todo(para):
+					if pattern.search(last):
+						hits.append((path, para[0][3], num, last if len(last) <= CONTEXT else "..." + last[-CONTEXT:]))
+				else:
+					last = data_text(('PARA', para)) or last
+				continue
+			for (lineno, text) in para_scopes(para, q):
+				if text and pattern.search(text):
+					hits.append((path, lineno, num, text))
+	return hits
+
+def search_one(args):
+	(path, q, outdir) = args
+	try:
+		return (path, search_book(path, q, outdir), None)
+	except Exception as e:
+		return (path, [], str(e))
+
+def search(paths, q, outdir, jobs):
+	work = [(path, q, outdir) for path in sorted(set(paths))]
+	if jobs <= 1 or len(work) < 2:
+		return [search_one(w) for w in work]
+	with ProcessPoolExecutor(max_workers=min(jobs, len(work))) as pool:
+		return list(pool.map(search_one, work))
+
+def main():
+	argpars = argparse.ArgumentParser(prog="textl search")
+	argpars.add_argument("pattern", nargs="?", help="regular expression (default: match everything)")
+	argpars.add_argument("--conf", default="conf")
+	argpars.add_argument("--proj", help="only these projects' books, separated by commas (default: all)")
+	argpars.add_argument("--tag", choices=TAGS, type=str.lower, help="only text inside this markup; narration is text outside dialog")
+	argpars.add_argument("--speaker", help="only dialog by this speaker, e.g. I or I>")
+	argpars.add_argument("--chapters", help="only these chapters, e.g. 10-20 or 1,4-6")
+	argpars.add_argument("--todo", action="store_true", help="find --- markers; the pattern matches the paragraph before them")
+	argpars.add_argument("-i", "--ignore-case", action="store_true")
+	argpars.add_argument("--outdir", default=OUT_DIR, help="the AST cache is kept in <outdir>/ast-cache/")
+	argpars.add_argument("-j", "--jobs", type=int, default=0, help="books searched at once (0 = one per core)")
+	args = argpars.parse_args()
+	if args.todo and (args.tag or args.speaker):
+		argpars.error("--todo can't be combined with --tag or --speaker")
+	if args.tag == "narration" and args.speaker:
+		argpars.error("narration has no speaker")
+
+	P.DEBUG = False
+	q = Query(args.pattern, args.tag, args.speaker, args.chapters, args.todo, args.ignore_case)
+	try:
+		q.compile()
+	except re.error as e:
+		argpars.error(f"bad pattern: {e}")
+	confdict = P.read_conf(args.conf)
+	paths = [p for p in conf_books(confdict, args.proj.split(",") if args.proj else None).values() if os.path.exists(p)]
+	jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+	found = 0
+	for (path, hits, err) in search(paths, q, os.path.join(args.outdir, ''), jobs):
+		if err:
+			P.warn(f"{path}: {err}")
+		for (path, lineno, num, text) in hits:
+			print(f"{path}:{lineno}: [{num}] {text}")
+		found += len(hits)
+	if not found:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -3,20 +3,24 @@ import sys
 import time
 import subprocess
 import datetime
+import json
 
 
-def timefunc(f):
-	def inner(*args, **kwargs):
-		start = time.time()
-		res = f(*args, **kwargs)
-
-		print("Time taken: %.03fs" % (time.time() - start))
-		return res
-	return inner
-
 def get_time(f):
 	return os.stat(f).st_mtime
 
+# The parser writes out/<name>.deps with the input and every %include'd file
+def get_watched(root, filename, name):
+	files = [filename]
+	depsfile = os.path.join(root, "out", name + ".deps")
+	if os.path.exists(depsfile):
+		with open(depsfile) as f:
+			files += [l.strip() for l in f if l.strip() and l.strip() not in files]
+	return files
+
+def get_times(files):
+	return {f: get_time(f) for f in files if os.path.exists(f)}
+
 
 class RunException(Exception):
 	def __init__(self, out, err):
@@ -24,9 +28,20 @@ class RunException(Exception):
 		self.err = err
 		super(RunException, self).__init__()
 
-@timefunc
-def build(name):
-	outp = run("./util/build %s html" % name)
+# The parser writes out/<name>.timings.json when run with --timings
+def print_timings(root, name, took):
+	timingsfile = os.path.join(root, "out", name + ".timings.json")
+	if not os.path.exists(timingsfile):
+		print("Time taken: %.03fs" % took)
+		return
+	with open(timingsfile) as f:
+		timings = json.load(f)
+	phases = ["%s %.03fs" % (p, secs) for (p, secs) in timings["phases"].items() if secs >= 0.0005]
+	print("Time taken: %.03fs (build %.03fs: %s)" % (took, timings["total"], ", ".join(phases)))
+
+def build(root, name):
+	start = time.time()
+	outp = run("./util/build %s html --timings" % name)
 	errs = [p for p in outp if len(p) > 0 and p[0] == "!" ]
 	if errs:
 		for p in outp:
@@ -36,6 +51,7 @@ def build(name):
 	if errs:
 		print(" with %d errors" % len(errs), end="")
 	print()
+	print_timings(root, name, time.time() - start)
 
 def count(root, f, docount):
 	if docount:
@@ -47,7 +63,7 @@ def run_build(root, filename, name, docount):
 	print("Running build at " + datetime.datetime.now().strftime("%H:%M:%S %Y-%m-%d "))
 	count(root,filename, docount)
 	try:
-		build(name)
+		build(root, name)
 	except RunException as exc:
 		for line in exc.out:
 			print(line)
@@ -89,12 +105,15 @@ def main():
 
 	if startbuild:
 		run_build(root,filename, name, docount)
-	t1 = get_time(filename)
+	watched = get_watched(root, filename, name)
+	t1 = get_times(watched)
 	while True:
 		time.sleep(1)
-		t2 = get_time(filename)
+		t2 = get_times(watched)
 		if t1 != t2:
 			run_build(root,filename, name, docount)
+			watched = get_watched(root, filename, name)
+			t2 = get_times(watched)
 		t1 = t2
 
 if __name__ == '__main__':